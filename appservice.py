@@ -0,0 +1,195 @@
+# coding=utf-8
+
+import asyncio
+from collections import OrderedDict
+import hmac
+import logging
+
+from aiohttp import web
+from nio import (
+    Event,
+    InviteMemberEvent,
+    MatrixRoom,
+    RoomGetStateResponse,
+    RoomMemberEvent,
+)
+
+from metrics import APPSERVICE_EVENTS
+
+logger = logging.getLogger(__name__)
+
+
+class AppServiceServer(object):
+    def __init__(self, client, hs_token, host="127.0.0.1", port=8090, remember=1000):
+        """Receives the events the homeserver pushes to the bot's application service
+
+        Instead of the bot syncing, the homeserver PUTs transactions of events
+        to this listener. They are handed to the client's event callbacks, the
+        same ones that would see them from a sync, with the room the client
+        would have built from its synced state. The client sends as the
+        application service by using its as_token as its access token.
+
+        Args:
+            client (nio.AsyncClient): The client whose event callbacks to run and
+                that keeps the room state
+
+            hs_token (str): The token the homeserver authenticates itself with
+
+            host (str): The address to listen on
+
+            port (int): The port to listen on, 0 for any free port
+
+            remember (int): How many transaction IDs to remember, so a
+                transaction the homeserver sends again is only processed once
+        """
+        self.client = client
+        self.hs_token = hs_token
+        self.host = host
+        self.port = port
+        self.remember = remember
+        self.transactions = 0
+        self._seen = OrderedDict()
+        self._loaded = set()
+        self._runner = None
+
+    def _authorised(self, request):
+        header = request.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            token = header[len("Bearer ") :]
+        else:
+            # Older homeservers send it as a query parameter
+            token = request.query.get("access_token", "")
+        return hmac.compare_digest(token, self.hs_token)
+
+    @staticmethod
+    def _error(status, errcode, error):
+        return web.json_response({"errcode": errcode, "error": error}, status=status)
+
+    async def _transaction(self, request):
+        if not self._authorised(request):
+            return self._error(403, "M_FORBIDDEN", "Bad hs_token")
+        txn_id = request.match_info["txn_id"]
+        attempt = self._seen.get(txn_id)
+        if attempt is None:
+            try:
+                body = await request.json()
+            except ValueError:
+                return self._error(400, "M_NOT_JSON", "Transaction isn't JSON")
+            # Remembered before it is processed, so a retry sent while this is
+            # still going waits for it instead of processing it again
+            attempt = asyncio.ensure_future(self._process(txn_id, body))
+            self._seen[txn_id] = attempt
+            if len(self._seen) > self.remember:
+                self._seen.popitem(last=False)
+        else:
+            logger.debug("Already got transaction %s", txn_id)
+        # Shielded so it is finished even if the homeserver stops waiting
+        await asyncio.shield(attempt)
+        return web.json_response({})
+
+    async def _process(self, txn_id, body):
+        events = body.get("events", [])
+        for source in events:
+            try:
+                await self._dispatch(source)
+            except Exception:
+                logger.exception("Failed to handle %s", source.get("event_id"))
+        self.transactions += 1
+        logger.debug("Processed transaction %s of %d events", txn_id, len(events))
+
+    async def _query(self, request):
+        # The bot doesn't create users or rooms on demand
+        if not self._authorised(request):
+            return self._error(403, "M_FORBIDDEN", "Bad hs_token")
+        return self._error(404, "M_NOT_FOUND", "Not provided by this service")
+
+    async def _ping(self, request):
+        if not self._authorised(request):
+            return self._error(403, "M_FORBIDDEN", "Bad hs_token")
+        return web.json_response({})
+
+    async def _load_state(self, room):
+        """Fill in a room the bot hasn't seen yet from its current state
+
+        Without it, rooms would all look like unnamed groups and their member
+        lists would be empty until the state changed.
+        """
+        self._loaded.add(room.room_id)
+        response = await self.client.room_get_state(room.room_id)
+        if not isinstance(response, RoomGetStateResponse):
+            logger.warning("Unable to get state of %s: %s", room.room_id, response)
+            return
+        for source in response.events:
+            self._apply_state(room, Event.parse_event(source))
+
+    @staticmethod
+    def _apply_state(room, event):
+        if isinstance(event, RoomMemberEvent):
+            room.handle_membership(event)
+        elif isinstance(event, Event):
+            room.handle_event(event)
+
+    async def _dispatch(self, source):
+        room_id = source.get("room_id")
+        if room_id is None:
+            return
+        APPSERVICE_EVENTS.inc()
+        room = self.client.rooms.get(room_id)
+        if room is None:
+            room = MatrixRoom(room_id, self.client.user_id)
+            self.client.rooms[room_id] = room
+
+        invite = False
+        if source.get("type") == "m.room.member":
+            membership = source.get("content", {}).get("membership")
+            invite = membership == "invite" and (
+                source.get("state_key") == self.client.user_id
+            )
+        # The state of a room the bot is only invited to can't be read yet
+        if not invite and room_id not in self._loaded:
+            await self._load_state(room)
+
+        event = Event.parse_event(source)
+        if "state_key" in source:
+            self._apply_state(room, event)
+        events = [event]
+        if invite:
+            # What a sync would have given the invite callbacks. from_dict takes
+            # the content out of the dict it is given.
+            events.append(InviteMemberEvent.from_dict(dict(source)))
+        for event in events:
+            for cb in self.client.event_callbacks:
+                if cb.filter is None or isinstance(event, cb.filter):
+                    await cb.func(room, event)
+
+    async def start(self):
+        app = web.Application()
+        for prefix in ("/_matrix/app/v1", ""):
+            # PUT is what the spec says, POST is accepted for test harnesses
+            app.router.add_put(prefix + "/transactions/{txn_id}", self._transaction)
+            app.router.add_post(prefix + "/transactions/{txn_id}", self._transaction)
+            app.router.add_get(prefix + "/users/{user_id}", self._query)
+            app.router.add_get(prefix + "/rooms/{alias}", self._query)
+        app.router.add_post("/_matrix/app/v1/ping", self._ping)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+        logger.info(
+            "Application service listening on http://%s:%s", self.host, self.port
+        )
+
+    async def run(self):
+        """Serve until the event loop is stopped
+
+        Like syncing, this doesn't return when stop is called, so shutting down
+        can carry on after the listener has stopped.
+        """
+        await self.start()
+        await asyncio.get_event_loop().create_future()
+
+    async def stop(self):
+        """Stop taking transactions, waiting for the ones being processed"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Measure the cost of working out which handler a message goes to
+
+Covers parsing the message into a Command and looking up its handler, not
+running the handler. Run from the repository root:
+
+    python benchmarks/dispatch.py [iterations]
+"""
+
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot_commands import Command  # noqa: E402
+
+MESSAGES = {
+    "exact trigger": "ticket " + "a1b2c3d4" * 8,
+    "admin trigger": "notice #room:hope.net hello everyone",
+    "fallback match": "thanks so much",
+    "no match": "what time does the keynote start?",
+}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, message in MESSAGES.items():
+        seconds = timeit(
+            lambda: Command(None, None, None, message, None, None).find_handler(),
+            number=iterations,
+        )
+        print(f"{name:>14}: {seconds / iterations * 1e6:6.2f} us/message")
+
+
+if __name__ == "__main__":
+    main()
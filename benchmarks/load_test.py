@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Measure how many ticket redemptions per second the bot can handle
+
+Starts a stand-in homeserver on localhost and points the real client, Callbacks
+and Command stack at it. Each simulated user DMs the bot `ticket <token>` with
+a token from a generated tokens.csv. Run from the repository root:
+
+    python benchmarks/load_test.py --users 500 --latency 20
+
+Reports redemption throughput, p50/p99 latency from a message arriving to its
+command finishing, and how many calls the homeserver got of each kind.
+
+With --appservice the bot runs as an application service: the messages are
+POSTed to its transaction listener in batches, as a homeserver would push them,
+instead of being handed to Callbacks directly.
+"""
+
+import argparse
+import asyncio
+from collections import Counter
+import csv
+import os
+import random
+import secrets
+import shutil
+import sys
+import tempfile
+from time import monotonic, time
+
+from aiohttp import ClientSession, web
+from nio import AsyncClientConfig, MatrixRoom, RoomMemberEvent, RoomMessageText
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from appservice import AppServiceServer  # noqa: E402
+from bot_commands import Command  # noqa: E402
+from callbacks import Callbacks  # noqa: E402
+from config import Config  # noqa: E402
+from executor import CommandExecutor  # noqa: E402
+from membership import MembershipIndex  # noqa: E402
+from outbound import OutboundQueue, QueuedAsyncClient  # noqa: E402
+from storage import Storage  # noqa: E402
+from token_backends import load_token_backends, token_digest  # noqa: E402
+
+SERVER = "bench.local"
+BOT = f"@bot:{SERVER}"
+HS_TOKEN = "bench-hs-token"
+
+
+class FakeHomeserver(object):
+    def __init__(self, latency=0.0, jitter=0.0):
+        """Just enough of the client-server API for the bot to redeem tickets
+
+        Args:
+            latency (float): Seconds to wait before answering each request
+
+            jitter (float): Up to this many more seconds are added at random
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._runner = None
+        self.url = None
+
+    async def _delay(self, call):
+        self.calls[call] += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def _login(self, request):
+        await self._delay("login")
+        return web.json_response(
+            {"user_id": BOT, "access_token": "bench", "device_id": "BENCH"}
+        )
+
+    async def _sync(self, request):
+        await self._delay("sync")
+        return web.json_response({"next_batch": "s1", "rooms": {}})
+
+    async def _filter(self, request):
+        await self._delay("filter")
+        return web.json_response({"filter_id": "1"})
+
+    async def _send(self, request):
+        await self._delay("room_send")
+        return web.json_response({"event_id": "$" + secrets.token_hex(8)})
+
+    async def _invite(self, request):
+        await self._delay("room_invite")
+        return web.json_response({})
+
+    async def _resolve_alias(self, request):
+        await self._delay("resolve_alias")
+        alias = request.match_info["alias"]
+        room_id = "!" + alias[1:].split(":")[0] + ":" + SERVER
+        return web.json_response({"room_id": room_id, "servers": [SERVER]})
+
+    async def _room_state(self, request):
+        await self._delay("room_state")
+        # Every room is an unnamed DM as far as the bot can tell
+        return web.json_response([])
+
+    async def _group_invite(self, request):
+        await self._delay("group_invite")
+        return web.json_response({"state": "invited"})
+
+    async def _unrecognised(self, request):
+        await self._delay("unrecognised")
+        return web.json_response(
+            {"errcode": "M_UNRECOGNIZED", "error": "Unrecognized request"}, status=404
+        )
+
+    async def start(self):
+        prefix = "/_matrix/client/{version}"
+        app = web.Application()
+        app.router.add_post(prefix + "/login", self._login)
+        app.router.add_get(prefix + "/sync", self._sync)
+        app.router.add_post(prefix + "/user/{user}/filter", self._filter)
+        app.router.add_put(prefix + "/rooms/{room}/send/{type}/{txn}", self._send)
+        app.router.add_post(prefix + "/rooms/{room}/invite", self._invite)
+        app.router.add_get(prefix + "/directory/room/{alias}", self._resolve_alias)
+        app.router.add_get(prefix + "/rooms/{room}/state", self._room_state)
+        app.router.add_put(
+            prefix + "/groups/{group}/admin/users/invite/{user}", self._group_invite
+        )
+        app.router.add_route("*", "/{path:.*}", self._unrecognised)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+def write_fixtures(directory, homeserver_url, digests, rooms, options):
+    """Write a config, room lists and token csvs for a run
+
+    Args:
+        directory (str): Where to put them
+
+        homeserver_url (str): The homeserver the bot should talk to
+
+        digests (list): Token digests for the attendee and presenter csvs, all
+            unused
+
+        rooms (list): Room IDs attendees are invited to
+
+        options (dict): Config options to use instead of the sample config's
+
+    Returns:
+        str: The path to the config
+    """
+    for name in ("tokens", "presenter_tokens"):
+        with open(os.path.join(directory, name + ".csv"), "w") as f:
+            writer = csv.writer(f)
+            for digest in digests:
+                writer.writerow([digest, "unused"])
+    with open(os.path.join(directory, "rooms.csv"), "w") as f:
+        f.write("\n".join(rooms))
+    for name in ("volunteer_tokens", "admin"):
+        open(os.path.join(directory, name + ".csv"), "w").close()
+    for name in ("volunteer_rooms", "presenter_rooms"):
+        with open(os.path.join(directory, name + ".csv"), "w") as f:
+            f.write(f"!{name}:{SERVER}")
+
+    # Start from the sample so every option the bot expects is there
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, "sample.config.yaml")) as f:
+        config = yaml.safe_load(f)
+    config["matrix"].update(
+        user_id=BOT, user_password="bench", homeserver_url=homeserver_url
+    )
+    config["storage"] = {
+        "database_filepath": os.path.join(directory, "bot.db"),
+        "store_filepath": os.path.join(directory, "store"),
+    }
+    config["logging"]["level"] = "WARNING"
+    for option in (
+        "rooms",
+        "tokens",
+        "volunteer_rooms",
+        "volunteer_tokens",
+        "presenter_rooms",
+        "presenter_tokens",
+    ):
+        config[option + "_path"] = os.path.join(directory, option + ".csv")
+    config["admin_csv"] = os.path.join(directory, "admin.csv")
+    config["announcement_csv"] = os.path.join(directory, "announcements.csv")
+    config["community"] = f"+bench:{SERVER}"
+    config["presenter_community"] = f"+presenters:{SERVER}"
+    for option, value in options.items():
+        if isinstance(value, dict):
+            config[option].update(value)
+        else:
+            config[option] = value
+    path = os.path.join(directory, "config.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def dm_source(user, index, body, attempt=0):
+    """The event source of a DM from user to the bot"""
+    return {
+        "type": "m.room.message",
+        "room_id": f"!dm{index}:{SERVER}",
+        "event_id": f"$ticket{index}-{attempt}",
+        "sender": user,
+        "origin_server_ts": int(time() * 1000),
+        "content": {"msgtype": "m.text", "body": body},
+    }
+
+
+def dm(user, index, body, attempt=0):
+    """A DM from user to the bot, and the room it was sent in"""
+    room = MatrixRoom(f"!dm{index}:{SERVER}", BOT)
+    event = RoomMessageText.from_dict(dm_source(user, index, body, attempt))
+    return room, event
+
+
+async def push_transactions(url, sources, size, arrival_rate):
+    """Send events to an application service the way a homeserver would
+
+    Args:
+        url (str): Where the application service listens
+
+        sources (list): The events to send
+
+        size (int): Events per transaction
+
+        arrival_rate (float): Events per second, 0 to send them all at once
+    """
+    headers = {"Authorization": f"Bearer {HS_TOKEN}"}
+    async with ClientSession() as session:
+        for start in range(0, len(sources), size):
+            batch = sources[start : start + size]
+            txn_url = f"{url}/_matrix/app/v1/transactions/{secrets.token_hex(8)}"
+            async with session.post(
+                txn_url, json={"events": batch}, headers=headers
+            ) as response:
+                response.raise_for_status()
+            if arrival_rate:
+                await asyncio.sleep(len(batch) / arrival_rate)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run(args):
+    homeserver = FakeHomeserver(args.latency / 1000, args.jitter / 1000)
+    await homeserver.start()
+    directory = tempfile.mkdtemp(prefix="corebot-load-")
+    all_tokens = [secrets.token_hex(32) for _ in range(args.tokens)]
+    tokens = all_tokens[: args.users]
+    config_path = write_fixtures(
+        directory,
+        homeserver.url,
+        [token_digest(token) for token in all_tokens],
+        [f"!room{i}:{SERVER}" for i in range(args.rooms)],
+        {
+            "token_backend": args.backend,
+            "command_workers": args.workers,
+            "invite_concurrency": args.invite_concurrency,
+            "outbound": {
+                "workers": args.outbound_workers,
+                "rate": args.outbound_rate,
+                "room_rate": 0,
+            },
+        },
+    )
+    config = Config(config_path)
+    store = Storage(config.database_filepath)
+    config.token_backends = load_token_backends(config, store)
+
+    outbound = OutboundQueue(
+        workers=config.outbound_workers,
+        rate=config.outbound_rate,
+        burst=config.outbound_burst,
+        room_rate=config.outbound_room_rate,
+        room_burst=config.outbound_room_burst,
+        max_retries=config.outbound_max_retries,
+    )
+    outbound.start()
+    client = QueuedAsyncClient(
+        homeserver.url,
+        BOT,
+        device_id="BENCH",
+        store_path=config.store_filepath,
+        config=AsyncClientConfig(
+            max_limit_exceeded=0, max_timeouts=0, encryption_enabled=False
+        ),
+        outbound=outbound,
+    )
+    appservice = None
+    if args.appservice:
+        client.access_token = "bench-as-token"
+        client.user_id = BOT
+        appservice = AppServiceServer(client, HS_TOKEN, port=0)
+        await appservice.start()
+    else:
+        await client.login(password="bench")
+        await client.sync(timeout=0)
+
+    config.command_executor = CommandExecutor(
+        workers=config.command_workers, max_queue=config.command_queue_size
+    )
+    config.command_executor.start()
+    config.membership = MembershipIndex(client)
+    callbacks = Callbacks(client, store, config)
+    client.add_event_callback(callbacks.message, (RoomMessageText,))
+    client.add_event_callback(config.membership.member, (RoomMemberEvent,))
+
+    # Time each command from its message arriving to it being finished
+    latencies = []
+    finished = asyncio.Event()
+    process = Command.process
+
+    async def timed_process(command):
+        try:
+            await process(command)
+        finally:
+            latencies.append(monotonic() - command.received)
+            if len(latencies) % len(tokens) == 0:
+                finished.set()
+
+    Command.process = timed_process
+
+    started = monotonic()
+    # Everyone redeems, then everyone redeems again once the first round is done
+    for attempt in range(args.repeats):
+        finished.clear()
+        if appservice is not None:
+            sources = [
+                dm_source(f"@user{i}:{SERVER}", i, f"ticket {token}", attempt)
+                for i, token in enumerate(tokens)
+            ]
+            url = f"http://127.0.0.1:{appservice.port}"
+            await push_transactions(
+                url, sources, args.transaction_size, args.arrival_rate
+            )
+        else:
+            for i, token in enumerate(tokens):
+                room, event = dm(f"@user{i}:{SERVER}", i, f"ticket {token}", attempt)
+                await callbacks.message(room, event)
+                if args.arrival_rate:
+                    await asyncio.sleep(1 / args.arrival_rate)
+        await finished.wait()
+    elapsed = monotonic() - started
+    Command.process = process
+
+    backend = config.token_backends["attendee"]
+    redeemed = sum(
+        1
+        for i, token in enumerate(tokens)
+        if backend.holder(token_digest(token)) == f"@user{i}:{SERVER}"
+    )
+    await config.command_executor.drain(config.shutdown_timeout)
+    await outbound.stop()
+    if appservice is not None:
+        await appservice.stop()
+    await client.close()
+    await homeserver.stop()
+
+    print(f"{len(tokens)} users, {args.tokens} tokens, {args.rooms} rooms")
+    print(f"homeserver latency {args.latency}ms +0-{args.jitter}ms")
+    print(f"redeemed:   {redeemed}/{len(tokens)}")
+    print(f"elapsed:    {elapsed:.2f}s")
+    print(f"throughput: {len(latencies) / elapsed:.1f} redemptions/s")
+    print(f"skipped:    {config.membership.skipped} invites to rooms users were in")
+    print(f"latency:    p50 {percentile(latencies, 0.5) * 1000:.1f}ms", end="")
+    print(f"  p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    print("homeserver calls:")
+    for call, count in sorted(homeserver.calls.items()):
+        print(f"  {call:>14}: {count}")
+    if args.keep:
+        print(f"fixtures left in {directory}")
+    else:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200, help="users redeeming")
+    parser.add_argument("--tokens", type=int, default=10000, help="tokens in the csv")
+    parser.add_argument("--rooms", type=int, default=10, help="rooms to invite to")
+    parser.add_argument(
+        "--latency", type=float, default=20, help="ms the homeserver takes to answer"
+    )
+    parser.add_argument("--jitter", type=float, default=10, help="extra random ms")
+    parser.add_argument(
+        "--arrival-rate",
+        type=float,
+        default=0,
+        help="messages per second, 0 to send them all at once",
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=1, help="times each user redeems their token"
+    )
+    parser.add_argument("--backend", choices=("csv", "sqlite"), default="csv")
+    parser.add_argument("--workers", type=int, default=16, help="command workers")
+    parser.add_argument("--invite-concurrency", type=int, default=8)
+    parser.add_argument("--outbound-workers", type=int, default=16)
+    parser.add_argument(
+        "--outbound-rate",
+        type=float,
+        default=0,
+        help="requests per second to the homeserver, 0 for no limit",
+    )
+    parser.add_argument(
+        "--appservice",
+        action="store_true",
+        help="run as an application service and push the messages to it",
+    )
+    parser.add_argument(
+        "--transaction-size",
+        type=int,
+        default=50,
+        help="events per transaction with --appservice",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the generated config and csvs"
+    )
+    args = parser.parse_args()
+    if args.users > args.tokens:
+        parser.error("--users can't be more than --tokens")
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
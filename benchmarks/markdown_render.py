@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Compare rendering canned responses with markdown() against render_markdown()
+
+Run from the repository root:
+
+    python benchmarks/markdown_render.py [iterations]
+"""
+
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markdown import markdown  # noqa: E402
+
+from bot_commands import STATIC_RESPONSES  # noqa: E402
+from chat_functions import prerender, render_markdown  # noqa: E402
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # What a redemption rush mostly sends, plus a reply that isn't canned
+    messages = STATIC_RESPONSES + ["invited to attendee group"]
+    prerender(STATIC_RESPONSES)
+
+    for name, render in (("markdown", markdown), ("render_markdown", render_markdown)):
+        seconds = timeit(lambda: [render(m) for m in messages], number=iterations)
+        per_message = seconds / (iterations * len(messages)) * 1e6
+        print(f"{name:>16}: {per_message:8.2f} us/message")
+
+
+if __name__ == "__main__":
+    main()
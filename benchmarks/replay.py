@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Replay a recorded event stream through the bot to compare handler latency
+
+Plays a file written by the bot's `record` option through Callbacks.message
+and Callbacks.invite, keeping the gaps between events (optionally sped up).
+The client is a stub that answers every request after a fixed latency, and
+every token in the recording is set up as an unused ticket so redemptions go
+down the same path they did live. Run from the repository root:
+
+    python benchmarks/replay.py data/events.jsonl --speed 10
+
+Reports command latency per trigger and the requests the stub received.
+"""
+
+import argparse
+import asyncio
+from collections import Counter, defaultdict
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from time import monotonic, time
+
+from load_test import BOT, percentile, SERVER, write_fixtures
+from nio import (
+    InviteMemberEvent,
+    JoinResponse,
+    MatrixRoom,
+    RoomInviteResponse,
+    RoomMessageText,
+    RoomResolveAliasResponse,
+    RoomSendResponse,
+)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot_commands import Command, HANDLERS  # noqa: E402
+from callbacks import Callbacks  # noqa: E402
+from config import Config  # noqa: E402
+from executor import CommandExecutor  # noqa: E402
+from membership import MembershipIndex  # noqa: E402
+from storage import Storage  # noqa: E402
+from token_backends import load_token_backends, token_digest  # noqa: E402
+
+TOKEN_RE = re.compile(r"\b[0-9a-f]{64}\b")
+
+
+class StubClient(object):
+    def __init__(self, latency=0.0):
+        """Stands in for the AsyncClient, answering every request with success
+
+        Args:
+            latency (float): Seconds each request takes
+        """
+        self.latency = latency
+        self.user = BOT
+        self.user_id = BOT
+        self.access_token = "replay"
+        self.rooms = {}
+        self.calls = Counter()
+
+    async def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def room_send(self, room_id, message_type, content, *args, **kwargs):
+        await self._call("room_send")
+        return RoomSendResponse("$replay", room_id)
+
+    async def room_invite(self, room_id, user_id):
+        await self._call("room_invite")
+        return RoomInviteResponse()
+
+    async def join(self, room_id):
+        await self._call("join")
+        return JoinResponse(room_id)
+
+    async def room_resolve_alias(self, alias):
+        await self._call("resolve_alias")
+        return RoomResolveAliasResponse(alias, "!" + alias[1:], [SERVER])
+
+    async def send(self, method, path, data=None, headers=None):
+        # community_invite
+        await self._call("group_invite")
+
+
+def load_recording(path):
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda r: r["time"])
+    return records
+
+
+def parse(record):
+    """Rebuild the room and event from a recorded line"""
+    room = MatrixRoom(record["room"]["room_id"], BOT)
+    # As if it had just been sent, so it isn't dropped for being old
+    record["event"]["origin_server_ts"] = int(time() * 1000)
+    if not record["room"]["is_group"]:
+        room.name = "recorded"
+    if record["kind"] == "invite":
+        return room, InviteMemberEvent.from_dict(record["event"])
+    return room, RoomMessageText.from_dict(record["event"])
+
+
+async def run(args):
+    records = load_recording(args.recording)
+    if not records:
+        print("Nothing recorded")
+        return
+    # Recorded tokens are already hashed, make those hashes the tokens
+    digests = set()
+    for record in records:
+        body = record["event"].get("content", {}).get("body", "")
+        digests.update(token_digest(t) for t in TOKEN_RE.findall(body))
+
+    directory = tempfile.mkdtemp(prefix="corebot-replay-")
+    config_path = write_fixtures(
+        directory,
+        "http://127.0.0.1:1",
+        sorted(digests),
+        [f"!room{i}:{SERVER}" for i in range(args.rooms)],
+        {"token_backend": args.backend, "command_workers": args.workers},
+    )
+    config = Config(config_path)
+    store = Storage(config.database_filepath)
+    config.token_backends = load_token_backends(config, store)
+    client = StubClient(args.latency / 1000)
+    config.command_executor = CommandExecutor(
+        workers=config.command_workers, max_queue=config.command_queue_size
+    )
+    config.command_executor.start()
+    config.membership = MembershipIndex(client)
+    callbacks = Callbacks(client, store, config)
+
+    latencies = defaultdict(list)
+    process = Command.process
+
+    async def timed_process(command):
+        try:
+            await process(command)
+        finally:
+            trigger = command.trigger if command.trigger in HANDLERS else "other"
+            latencies[trigger].append(monotonic() - command.received)
+
+    Command.process = timed_process
+
+    first = records[0]["time"]
+    started = monotonic()
+    for record in records:
+        if args.speed:
+            delay = (record["time"] - first) / args.speed - (monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        room, event = parse(record)
+        if record["kind"] == "invite":
+            await callbacks.invite(room, event)
+        else:
+            await callbacks.message(room, event)
+    await config.command_executor.drain(args.timeout)
+    elapsed = monotonic() - started
+    Command.process = process
+
+    recorded = records[-1]["time"] - first
+    print(f"{len(records)} events recorded over {recorded:.1f}s")
+    print(f"replayed in {elapsed:.1f}s at speed {args.speed or 'max'}")
+    print(f"{'trigger':>14} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for trigger, values in sorted(latencies.items()):
+        print(
+            f"{trigger:>14} {len(values):>6} "
+            f"{percentile(values, 0.5) * 1000:>8.1f} "
+            f"{percentile(values, 0.99) * 1000:>8.1f} "
+            f"{max(values) * 1000:>8.1f}"
+        )
+    print("requests:")
+    for call, count in sorted(client.calls.items()):
+        print(f"  {call:>14}: {count}")
+    shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording", help="JSONL file written by the record option")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="how many times faster than recorded, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=20, help="ms each request to the stub takes"
+    )
+    parser.add_argument("--rooms", type=int, default=10, help="rooms to invite to")
+    parser.add_argument("--backend", choices=("csv", "sqlite"), default="csv")
+    parser.add_argument("--workers", type=int, default=16, help="command workers")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300,
+        help="seconds to wait for commands still running at the end",
+    )
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
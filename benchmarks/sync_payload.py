@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Compare the size of an initial sync with and without the bot's sync filter
+
+Logs in as the bot, using the same config file as main.py, and fetches a
+full initial sync twice. Run from the repository root:
+
+    python benchmarks/sync_payload.py [config path]
+"""
+
+import asyncio
+import json
+import os
+import sys
+from time import monotonic
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nio import Api, AsyncClient, LoginResponse  # noqa: E402
+
+from bot_actions import build_sync_filter  # noqa: E402
+from config import Config  # noqa: E402
+
+
+async def fetch_sync(client, sync_filter):
+    method, path = Api.sync(client.access_token, timeout=0, filter=sync_filter)
+    started = monotonic()
+    response = await client.send(method, path)
+    body = await response.read()
+    return len(body), monotonic() - started, json.loads(body)
+
+
+async def main():
+    config_filepath = sys.argv[1] if len(sys.argv) > 1 else "data/config.yaml"
+    config = Config(config_filepath)
+    client = AsyncClient(
+        config.homeserver_url, config.user_id, device_id=config.device_id
+    )
+    try:
+        login = await client.login(
+            password=config.user_password, device_name=config.device_name
+        )
+        if not isinstance(login, LoginResponse):
+            print(f"Failed to login: {login}")
+            return
+        results = {}
+        for name, sync_filter in (
+            ("unfiltered", None),
+            ("filtered", build_sync_filter(config)),
+        ):
+            size, seconds, body = await fetch_sync(client, sync_filter)
+            results[name] = size
+            joined = body.get("rooms", {}).get("join", {})
+            events = sum(
+                len(room.get(section, {}).get("events", []))
+                for room in joined.values()
+                for section in ("timeline", "state", "ephemeral")
+            )
+            print(
+                f"{name:>10}: {size / 1024:10.1f} KiB, {events:7d} room events, "
+                f"{len(joined)} rooms, {seconds:.2f}s"
+            )
+        print(f"filtered sync is {results['filtered'] / results['unfiltered']:.1%}")
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
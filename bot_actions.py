@@ -1,31 +1,76 @@
 # coding=utf-8
 
 import asyncio
-import csv
 from datetime import datetime
-from hashlib import sha256
 import logging
-from os import fsync, rename
+from os import stat
+from time import monotonic
 from typing import Optional
 
 from dateutil import tz
-from nio import Api, RoomResolveAliasResponse
-
-from chat_functions import send_text_to_room
+from nio import (
+    Api,
+    JoinError,
+    RoomInviteError,
+    RoomResolveAliasError,
+    RoomResolveAliasResponse,
+    UploadFilterResponse,
+)
+
+from chat_functions import make_text_content, send_content_to_room
+from disk_io import run_io, write_csv_atomic
+from metrics import (
+    ANNOUNCEMENT_LAG,
+    INVITES_SKIPPED,
+    TOKENS_IMPORTED,
+    WRITE_DURATION,
+)
+from token_backends import TICKET_TYPES, token_digest
+from tracing import span
 
 logger = logging.getLogger(__name__)
 
+# Tasks nothing waits for, kept so they aren't garbage collected while running
+_background = set()
+
+
+def start_background(coro, what):
+    """Run a coroutine without waiting for it, logging it if it fails
+
+    Args:
+        coro (coroutine): What to run
+
+        what (str): What it does, for the log
+    """
+    task = asyncio.create_task(coro)
+    _background.add(task)
+
+    def done(task):
+        _background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error in %s", what, exc_info=task.exception())
+
+    task.add_done_callback(done)
+    return task
+
+
+def claim_token(token, backend, sender):
+    """Reserve a token for sender if it is valid for them
+
+    Should be called with the backend's lock held. The claim takes effect
+    immediately so the lock can be released before any network I/O.
+
+    Returns:
+        tuple: (valid, digest, previous holder of the token)
+    """
+    h = token_digest(token)
+    valid, previous = backend.claim(h, sender)
+    return valid, h, previous
 
-def valid_token(token, tokens, sender):
-    h = sha256()
-    h.update(token.encode("utf-8"))
-    msg = h.hexdigest()
-    if msg in tokens:
-        if tokens[msg] == "unused":
-            return True, msg
-        elif tokens[msg] == sender:
-            return True, msg
-    return False, msg
+
+def release_token(backend, h, sender, previous):
+    """Roll back a claim made with claim_token"""
+    backend.release(h, sender, previous)
 
 
 async def community_invite(client, group, sender):
@@ -36,127 +81,380 @@ async def community_invite(client, group, sender):
     query_parameters = {"access_token": client.access_token}
     path = Api._build_path(path, query_parameters)
     logger.debug("community_invite path: %r", path)
-    await client.send(
-        "PUT", path, Api.to_json(data), headers={"Content-Type": "application/json"}
-    )
+    with span("community_invite", group=group):
+        await client.send(
+            "PUT",
+            path,
+            Api.to_json(data),
+            headers={"Content-Type": "application/json"},
+        )
     return
 
 
-def is_admin(config, user):
-    user = str(user)
-    logger.debug("is_admin? %s", user)
+async def invite_to_rooms(client, rooms, user, concurrency=8, members=None):
+    """Invite a user to a list of rooms, several at a time
+
+    Args:
+        client (nio.AsyncClient): The client to communicate to matrix with
+
+        rooms (list): Room IDs to invite the user to
+
+        user (str): The user to invite
+
+        concurrency (int): How many invites may be in flight at once
+
+        members (MembershipIndex): Used to skip rooms the user is already in
+
+    Returns:
+        list: The rooms the user could not be invited to
+    """
+    if members is not None:
+        wanted = len(rooms)
+        rooms = [r for r in rooms if not members.is_member(r, user)]
+        if len(rooms) < wanted:
+            members.skipped += wanted - len(rooms)
+            INVITES_SKIPPED.inc(amount=wanted - len(rooms))
+            logger.debug("%s is already in %d rooms", user, wanted - len(rooms))
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def _invite(room):
+        async with semaphore:
+            with span("room_invite", room=room):
+                return await client.room_invite(room, user)
+
+    results = await asyncio.gather(*[_invite(r) for r in rooms], return_exceptions=True)
+    failed = []
+    for room, result in zip(rooms, results):
+        if isinstance(result, RoomInviteError):
+            # Not a failure, they already have what they asked for
+            if "already in the room" in (result.message or ""):
+                if members is not None:
+                    members.invited(room, user)
+                continue
+            logger.warning("Failed to invite %s to %s: %s", user, room, result)
+            failed.append(room)
+        elif isinstance(result, Exception):
+            logger.warning("Failed to invite %s to %s: %r", user, room, result)
+            failed.append(room)
+        elif members is not None:
+            members.invited(room, user)
+    return failed
+
+
+def _read_admins(path):
+    mtime = stat(path).st_mtime
+    with open(path, "r") as f:
+        return mtime, {nick.rstrip() for nick in f.readlines() if nick.strip()}
+
+
+def _admins_mtime(path):
+    try:
+        return stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+async def load_admins(config):
+    """(Re)load the admin list from the admin csv
+
+    Returns:
+        int: The number of admins loaded
+    """
     try:
-        with open(config.admin_csv_path, "r") as f:
-            for nick in f.readlines():
-                if user == nick.rstrip():
-                    logger.debug("is_admin! %s", user)
-                    return True
+        mtime, admins = await run_io(_read_admins, config.admin_csv_path)
     except FileNotFoundError:
         logger.error("No admin csv")
+        mtime = None
+        admins = set()
+    config._admins = admins
+    config._admins_mtime = mtime
+    config._admins_checked = monotonic()
+    logger.info("Loaded %d admins", len(admins))
+    return len(admins)
+
+
+async def is_admin(config, user):
+    user = str(user)
+    # Only look at the file every so often, and only read it if it changed
+    if monotonic() - config._admins_checked >= config.admin_recheck_interval:
+        config._admins_checked = monotonic()
+        mtime = await run_io(_admins_mtime, config.admin_csv_path)
+        if mtime != config._admins_mtime:
+            await load_admins(config)
+    if user in config._admins:
+        logger.debug("is_admin! %s", user)
+        return True
     logger.debug("not admin: %s", user)
     return False
 
 
-async def write_csv(config, ticket_type):
-    logger.info("Writing %s ticket csv", ticket_type)
-
-    lock = config._attendee_token_lock
-    tokens = config.tokens
-    filename = config.tokens_path
-    if ticket_type == "presenter":
-        lock = config._presenter_token_lock
-        tokens = config.presenter_tokens
-        filename = config.presenter_tokens_path
-    elif ticket_type == "volunteer":
-        lock = config._volunteer_token_lock
-        tokens = config.volunteer_tokens
-        filename = config.volunteer_tokens_path
-
-    async with lock:
-        filename_temp = filename + ".atomic"
-        with open(filename_temp, "w") as f:
-            csv_writer = csv.writer(f)
-            csv_writer.writerows(tokens.items())
-            f.flush()
-            fsync(f.fileno())
-        rename(filename_temp, filename)
+async def write_csv(config, ticket_type, force=False):
+    """Persist a token table through its backend
+
+    For csv backends this writes the csv and folds in its journal. The table is
+    copied while holding its lock and written out on the disk I/O thread after
+    letting go of it, so redemptions aren't held up by the write. Writes of the
+    same table take turns. Tokens appended to the csv are merged in first, so
+    writing it doesn't lose them.
+
+    Args:
+        config (Config): Bot configuration parameters
+
+        ticket_type (str): attendee, volunteer or presenter
+
+        force (bool): Write the table even if it hasn't changed since the last write
+
+    Returns:
+        bool: Whether the table was written
+    """
+    backend = config.token_backends[ticket_type]
+
+    async with backend.write_lock:
+        new_tokens = await run_io(backend.tail.read_new)
+        await _merge_tokens(backend, new_tokens)
+        async with backend.lock:
+            generation = backend.generation
+            if not force and generation == backend.persisted_generation:
+                config.skipped_writes += 1
+                logger.debug("%s tickets unchanged, not writing", ticket_type)
+                return False
+            snapshot = backend.snapshot()
+
+        logger.info("Writing %s tickets", ticket_type)
+        with WRITE_DURATION.time(ticket_type):
+            await backend.write(snapshot)
+        backend.persisted_generation = generation
 
     logger.debug("Done writing")
+    return True
 
 
-async def sync_data(config):
-    for ticket_type in ["attendee", "volunteer", "presenter"]:
-        await write_csv(config, ticket_type)
+async def _merge_tokens(backend, tokens):
+    if not tokens:
+        return 0
+    added = await backend.merge(tokens)
+    if added:
+        TOKENS_IMPORTED.inc(backend.ticket_type, amount=added)
+        logger.info("Imported %d new %s tokens", added, backend.ticket_type)
+    return added
 
 
-async def periodic_sync(config):
+async def import_tokens(config):
+    """Add the tokens appended to the token csvs since they were last read
+
+    Only the new rows are read, and tokens already known keep their holders.
+    Tables that gained tokens are written out straight away.
+
+    Args:
+        config (Config): Bot configuration parameters
+
+    Returns:
+        dict: The number of tokens added by ticket type
+    """
+    imported = {}
+    for ticket_type in TICKET_TYPES:
+        backend = config.token_backends[ticket_type]
+        new_tokens = await run_io(backend.tail.read_new)
+        imported[ticket_type] = await _merge_tokens(backend, new_tokens)
+        if imported[ticket_type]:
+            await write_csv(config, ticket_type)
+    return imported
+
+
+async def watch_tokens(config):
+    """Import new tokens every token_watch_interval seconds"""
     while True:
-        await asyncio.sleep(config.sync_interval)
-        await sync_data(config)
+        await asyncio.sleep(config.token_watch_interval)
+        try:
+            await import_tokens(config)
+        except Exception:
+            logger.exception("Unable to import new tokens")
+
+
+async def sync_data(config, store):
+    """Write out any token tables that have changed and checkpoint the database
+
+    The database is only checkpointed here, on the disk I/O thread, so commits
+    made from the event loop never wait for one.
+
+    Args:
+        config (Config): Bot configuration parameters
+
+        store (Storage): Bot storage
 
+    Returns:
+        int: The number of tables written
+    """
+    written = 0
+    for ticket_type in TICKET_TYPES:
+        if await write_csv(config, ticket_type):
+            written += 1
+    await run_io(store.checkpoint)
+    return written
 
-async def get_roomid(client, alias):
-    resp = await client.room_resolve_alias(alias)
-    if not isinstance(resp, RoomResolveAliasResponse):
+
+async def periodic_sync(config, store):
+    while True:
+        await asyncio.sleep(config.sync_interval)
+        await sync_data(config, store)
+
+
+def build_sync_filter(config):
+    """Build the sync filter that keeps the bot from downloading what it ignores
+
+    Returns:
+        dict: The filter, see https://matrix.org/docs/spec/client_server/r0.6.1#filtering
+    """
+    timeline = {
+        "limit": config.sync_filter_timeline_limit,
+        # Nothing the bot reacts to
+        "not_types": ["m.reaction", "m.sticker", "m.room.redaction", "m.call.*"],
+    }
+    if config.sync_filter_broadcast_rooms:
+        timeline["not_rooms"] = config.sync_filter_broadcast_rooms
+    return {
+        "presence": {"not_types": ["*"]},
+        "room": {
+            "ephemeral": {"not_types": ["*"]},
+            "state": {"lazy_load_members": config.sync_filter_lazy_load_members},
+            "timeline": timeline,
+        },
+    }
+
+
+async def upload_sync_filter(client, config):
+    """Upload the sync filter
+
+    Returns:
+        str: The filter ID to sync with, or None to sync without one
+    """
+    if not config.sync_filter_enabled:
+        return None
+    sync_filter = build_sync_filter(config)
+    resp = await client.upload_filter(
+        presence=sync_filter["presence"], room=sync_filter["room"]
+    )
+    if not isinstance(resp, UploadFilterResponse):
+        logger.error("Unable to upload sync filter, syncing without one: %s", resp)
+        return None
+    logger.debug("Uploaded sync filter %s", resp.filter_id)
+    return resp.filter_id
+
+
+async def get_roomid(client, config, alias):
+    if alias.startswith("!"):
+        # Already a room ID
+        return True, alias
+    cached, room_id = config._room_alias_cache.get(alias)
+    if not cached:
+        with span("get_roomid", alias=alias):
+            resp = await client.room_resolve_alias(alias)
+        if isinstance(resp, RoomResolveAliasResponse):
+            room_id = resp.room_id
+            config._room_alias_cache.put(alias, room_id)
+        elif isinstance(resp, RoomResolveAliasError):
+            # Only remember aliases that definitely don't exist
+            if resp.status_code == "M_NOT_FOUND":
+                config._room_alias_cache.put(alias, None)
+    if room_id is None:
         logger.info("notice: bad room alias %s", alias)
         return False, ""
-    return True, resp.room_id
+    return True, room_id
+
+
+async def warm_room_aliases(client, config):
+    """Resolve the aliases we know we'll need ahead of time"""
+    rooms = config.rooms + config.volunteer_rooms + config.presenter_rooms
+    rooms.append(config.oncall_room)
+    rooms.extend(a.room for a in config._announcements)
+    aliases = {r for r in rooms if r and r.startswith("#")}
+    semaphore = asyncio.Semaphore(max(1, config.invite_concurrency))
+
+    async def _resolve(alias):
+        async with semaphore:
+            return await get_roomid(client, config, alias)
+
+    results = await asyncio.gather(
+        *[_resolve(a) for a in aliases], return_exceptions=True
+    )
+    resolved = sum(1 for r in results if not isinstance(r, Exception) and r[0])
+    logger.info("Resolved %d of %d room aliases", resolved, len(aliases))
 
 
 class Announcement:
     time: datetime
     room: str
     message: str
-    _task: Optional[asyncio.Task]
+    fire_latency: Optional[float]
+    _room_id: Optional[str]
+    _content: Optional[dict]
     _logger: logging.Logger
 
-    def __init__(self, client, time: datetime, room: str, message: str):
+    def __init__(self, client, config, time: datetime, room: str, message: str):
         self._client = client
+        self._config = config
         if not isinstance(time, datetime):
             self.time = datetime.fromisoformat(time)
         else:
             self.time = time
         self.room = room
         self.message = message
-        self._task = None
+        # Seconds between the scheduled time and the send, once sent
+        self.fire_latency = None
+        self._room_id = None
+        self._content = None
         self._logger = logging.getLogger(__name__)
 
     def to_list(self) -> list:
         return [self.time.isoformat(), self.room, self.message]
 
-    async def schedule(self):
-        if self.time > datetime.now(tz.UTC) and (
-            self._task is None or self._task.cancelled()
-        ):
-            self._task = asyncio.create_task(self._announce_later())
-        else:
-            logger.debug("Not scheduling past announcement for %s", self.time)
-
-    async def _announce_later(self):
-        """Coroutine to wait until scheduled time for announcement"""
-        wait_seconds = (self.time - datetime.now(tz.UTC)).total_seconds()
-        self._logger.info(
-            "Waiting %s seconds to announce to %s at %s: %r",
-            wait_seconds,
-            self.room,
-            self.time,
-            self.message,
-        )
-        await asyncio.sleep(wait_seconds)
-        await self.announce()
+    async def prepare(self):
+        """Resolve the room, join it if need be and render the message ahead of time
 
-    async def announce(self):
-        """Post announcement"""
-        self._logger.info(
-            "Announcing to %s at %s: %r", self.room, self.time, self.message,
-        )
-        ret, room_id = await get_roomid(self._client, self.room)
+        Returns:
+            bool: Whether the announcement is ready to send
+        """
+        ret, room_id = await get_roomid(self._client, self._config, self.room)
         if not ret:
             self._logger.error(
                 "Could not find a roomid for scheduled message to %s", self.room
             )
+            return False
+        if room_id not in self._client.rooms:
+            self._logger.warning(
+                "Not joined to %s (%s) for scheduled message at %s, joining",
+                self.room,
+                room_id,
+                self.time,
+            )
+            resp = await self._client.join(room_id)
+            if isinstance(resp, JoinError):
+                self._logger.error(
+                    "Unable to join %s for scheduled message at %s: %s",
+                    self.room,
+                    self.time,
+                    resp.message,
+                )
+                return False
+        self._room_id = room_id
+        self._content = make_text_content(self.message, notice=False)
+        self._logger.debug("Prepared announcement to %s at %s", self.room, self.time)
+        return True
+
+    async def announce(self):
+        """Post announcement"""
+        if self._content is None and not await self.prepare():
             return
-        await send_text_to_room(self._client, room_id, self.message, notice=False)
+        await send_content_to_room(self._client, self._room_id, self._content)
+        self.fire_latency = (datetime.now(tz.UTC) - self.time).total_seconds()
+        ANNOUNCEMENT_LAG.observe(self.fire_latency)
+        self._logger.info(
+            "Announced to %s at %s (%.3fs late): %r",
+            self.room,
+            self.time,
+            self.fire_latency,
+            self.message,
+        )
 
 
 async def add_announcement(config, new_announcement, write=True):
@@ -164,7 +462,13 @@ async def add_announcement(config, new_announcement, write=True):
     async with config._announcement_lock:
         if new_announcement.time.tzinfo is None:
             raise Exception("MissingTimezone")
-        await new_announcement.schedule()
+        if config._announcement_scheduler.add(new_announcement):
+            logger.info(
+                "Scheduled announcement to %s at %s: %r",
+                new_announcement.room,
+                new_announcement.time,
+                new_announcement.message,
+            )
         config._announcements.append(new_announcement)
     if write:
         await write_announcements(config)
@@ -175,31 +479,19 @@ async def reset_announcements(config, stop=False):
     async with config._announcement_lock:
         if stop:
             # Stop all
-            tasks = [
-                t
-                for t in asyncio.all_tasks()
-                if t.get_coro().__name__ == "_announce_at"
-            ]
-            [task.cancel() for task in tasks]
-            await asyncio.gather(tasks)
-
-        # Start all
-        [a.schedule() for a in config._announcements]
+            config._announcement_scheduler.cancel_all()
+
+        # Start all, anything still scheduled is left alone
+        for a in config._announcements:
+            config._announcement_scheduler.add(a)
     logger.debug("Reset announcements")
 
 
 async def write_announcements(config):
     logger.info("Writing announcement csv")
     async with config._announcement_lock:
-        filename = config.announcement_csv
-        filename_temp = filename + ".atomic"
-        with open(filename_temp, "w") as f:
-            csv_writer = csv.writer(f)
-            for announcement in config._announcements:
-                csv_writer.writerow(announcement.to_list())
-            f.flush()
-            fsync(f.fileno())
-        rename(filename_temp, filename)
+        rows = [announcement.to_list() for announcement in config._announcements]
+    await run_io(write_csv_atomic, config.announcement_csv, rows)
     logger.debug("Wrote announcement csv")
 
 
@@ -210,7 +502,7 @@ async def is_authed(client, config, sender, roomid):
     #    path = Api._build_path(path, query_parameters)
     #    resp = await client._send("GET", path )
     #    print(resp)
-    if sender in config.volunteer_tokens.values():
+    if config.token_backends["volunteer"].is_holder(sender):
         logger.info("authed for volunteers")
         await client.room_invite(roomid, sender)
     return False
@@ -3,23 +3,120 @@
 from datetime import datetime
 import logging
 import re
+from time import monotonic
 
 from dateutil import tz
 
 from bot_actions import (
     add_announcement,
     Announcement,
+    claim_token,
     community_invite,
     get_roomid,
+    import_tokens,
+    invite_to_rooms,
     is_admin,
     is_authed,
+    load_admins,
+    release_token,
     sync_data,
-    valid_token,
 )
 from chat_functions import send_text_to_room
+from metrics import COMMAND_LATENCY, COMMANDS, REDEMPTIONS
+from token_backends import TICKET_TYPES
+from tracing import annotate, span, start_trace
 
 logger = logging.getLogger(__name__)
 
+HELP_TEXT = (
+    "Hello, I'm the HOPE CoreBot! To be invited to the official "
+    "conference channels message me with `ticket <your-token-here>`. "
+    "You can find more information (important for presenters) on the "
+    "[conference bot wiki](https://wiki.hope.net/index.php?title=Conference_bot)."
+)
+THANKS_RESPONSE = "Hey no problem, have a good HOPE!"
+HI_RESPONSE = "Hi there, I'm a bot. Try typing `help` if you need some guidance"
+JUST_TOKEN_RESPONSE = (
+    "I think you posted just your ticket code. Add the ticket "
+    "code from your email after the command, like this:  \n"
+    "`ticket a1b2c3d4e5...`  \n"
+    "or  \n"
+    "`presenter a1b2c3d4e5...`"
+)
+TOKEN_USAGE = (
+    "Add the ticket code from your email after the command, like this:  \n"
+    "`{trigger} a1b2c3d4e5...`"
+)
+TOKEN_LENGTH_USAGE = TOKEN_USAGE + (
+    "Token must be 64 characters, check your ticket again or if you "
+    "have trouble, please send an email to helpdesk2020@helpdesk.hope.net"
+)
+VERIFIED_TICKET = (
+    "Verified ticket. You should now be invited to the HOPE "
+    "{ticket_type} chat rooms and community."
+)
+INVALID_TOKEN = (
+    "This is not a valid token, check your ticket again or "
+    "email helpdesk2020@helpdesk.hope.net  \n"
+    "If you are a `volunteer` or `presenter`, use those commands "
+    "instead of `ticket`"
+)
+WRONG_PASSWORD = "Sorry, wrong password, try again?"
+
+# Rendered once at startup, see chat_functions.prerender
+STATIC_RESPONSES = [
+    HELP_TEXT,
+    THANKS_RESPONSE,
+    HI_RESPONSE,
+    JUST_TOKEN_RESPONSE,
+    INVALID_TOKEN,
+    WRONG_PASSWORD,
+    *(TOKEN_USAGE.format(trigger=t) for t in ("ticket", "request", "presenter")),
+    *(TOKEN_LENGTH_USAGE.format(trigger=t) for t in ("ticket", "request", "presenter")),
+    *(VERIFIED_TICKET.format(ticket_type=t) for t in TICKET_TYPES),
+]
+
+
+class Handler(object):
+    __slots__ = ("method", "admin", "kwargs")
+
+    def __init__(self, method, admin, kwargs):
+        """How to handle a command trigger
+
+        Args:
+            method (coroutine function): The Command method to call
+
+            admin (bool): Whether only admins may use it
+
+            kwargs (dict): Extra arguments to call the method with
+        """
+        self.method = method
+        self.admin = admin
+        self.kwargs = kwargs
+
+
+# Command triggers and their handlers, filled in by @command
+HANDLERS = {}
+
+
+def command(*triggers, admin=False, **kwargs):
+    """Register a Command method as the handler for one or more triggers
+
+    Args:
+        triggers (str): The lowercase first words of the commands it handles
+
+        admin (bool): Whether only admins may use it
+
+        kwargs: Extra arguments to call the method with
+    """
+
+    def register(method):
+        for trigger in triggers:
+            HANDLERS[trigger] = Handler(method, admin, kwargs)
+        return method
+
+    return register
+
 
 class Command(object):
     def __init__(self, client, store, config, command, room, event):
@@ -44,138 +141,130 @@ class Command(object):
         self.command = command
         self.room = room
         self.event = event
-        self.args = self.command.split()[1:]
+        # Parsed once here, handlers use these rather than re-splitting
+        words = self.command.split()
+        self.trigger = words[0].lower() if words else ""
+        self.args = words[1:]
+        self.received = monotonic()
 
     async def process(self):
         """Process the command"""
         logger.debug("Got command from %s: %r", self.event.sender, self.command)
-        trigger = self.command.lower().split(maxsplit=1)[0]
-        if trigger.startswith("help"):
-            await self._show_help()
-        elif trigger == "request":
-            await self._process_request("attendee")
-        elif trigger == "ticket":
-            await self._process_request("attendee")
-        elif trigger == "volunteer":
-            await self._volunteer_request("volunteer")
-            # await self._process_request("volunteer")
-        elif trigger == "presenter":
-            await self._process_request("presenter")
-        elif trigger == "hack":
-            await self._the_planet()
-        elif trigger == "trashing":
-            await self._trashing()
-        elif trigger == "notice":
-            if is_admin(self.config, self.event.sender):
-                await self._notice()
-        elif trigger == "sync":
-            if is_admin(self.config, self.event.sender):
-                await self._sync()
-        elif trigger == "invite_group":
-            if is_admin(self.config, self.event.sender):
-                await self._invite_group()
-        elif trigger == "invite":
-            if is_admin(self.config, self.event.sender):
-                await self._invite()
-        elif trigger == "oncall":
-            await self._volunteer_request("oncall")
-        elif trigger == "schedule_announce":
-            if is_admin(self.config, self.event.sender):
-                await self._schedule_announcement()
-        elif re.search(r"\bty\b|\bthx\b|thank|\bthanx\b", trigger) is not None:
-            await send_text_to_room(
-                self.client, self.room.room_id, "Hey no problem, have a good HOPE!"
-            )
-        elif re.search(r"\bhi\b|\bhello\b|\bhey\b", trigger) is not None:
-            await send_text_to_room(
-                self.client,
-                self.room.room_id,
-                "Hi there, I'm a bot. Try typing `help` if you need some guidance",
-            )
-        elif len(trigger) >= 63 and " " not in trigger:
-            response = (
-                "I think you posted just your ticket code. Add the ticket "
-                "code from your email after the command, like this:  \n"
-                "`ticket a1b2c3d4e5...`  \n"
-                "or  \n"
-                "`presenter a1b2c3d4e5...`"
-            )
-            await send_text_to_room(self.client, self.room.room_id, response)
+        handler = self.find_handler()
+        if handler is None:
+            return
+        if handler.admin and not await is_admin(self.config, self.event.sender):
+            return
+        # Fallback triggers are whatever the user typed, so label by handler
+        label = self.trigger
+        if label not in HANDLERS:
+            label = handler.method.__name__.strip("_")
+        try:
+            with start_trace(
+                "command",
+                started=self.received,
+                trigger=label,
+                sender=self.event.sender,
+            ):
+                await handler.method(self, **handler.kwargs)
+        finally:
+            COMMANDS.inc(label)
+            COMMAND_LATENCY.observe(monotonic() - self.received, label)
+
+    def find_handler(self):
+        """Get the Handler for this command, or None if nothing handles it"""
+        handler = HANDLERS.get(self.trigger)
+        if handler is not None:
+            return handler
+        for matches, handler in FALLBACK_HANDLERS:
+            if matches(self.trigger):
+                return handler
+        return None
 
+    @command("hack")
+    async def _the_planet(self):
+        text = "HACK THE PLANET https://youtu.be/YV78vobCyIo?t=55"
+        await send_text_to_room(self.client, self.room.room_id, text)
+
+    @command("trashing")
+    async def _trashing(self):
+        text = """They\'re TRASHING our rights, man! They\'re
+        TRASHING the flow of data! They\'re TRASHING!
+        TRASHING! TRASHING! HACK THE PLANET! HACK
+        THE PLANET!"""
+        await send_text_to_room(self.client, self.room.room_id, text)
+
+    async def _thanks(self):
+        await send_text_to_room(self.client, self.room.room_id, THANKS_RESPONSE)
+
+    async def _hi(self):
+        await send_text_to_room(self.client, self.room.room_id, HI_RESPONSE)
+
+    async def _just_token(self):
+        await send_text_to_room(self.client, self.room.room_id, JUST_TOKEN_RESPONSE)
+
+    @command("ticket", "request", ticket_type="attendee")
+    @command("presenter", ticket_type="presenter")
     async def _process_request(self, ticket_type):
         """!h $ticket_type $token"""
         if not self.args:
-            response = (
-                "Add the ticket code from your email after the command, like this:  \n"
-                f"`{ self.command.lower().split(maxsplit=1)[0] } a1b2c3d4e5...`"
-            )
+            response = TOKEN_USAGE.format(trigger=self.trigger)
             await send_text_to_room(self.client, self.room.room_id, response)
             return
         logger.debug("ticket cmd from %s for %s", self.event.sender, ticket_type)
         token = str(self.args[0]).strip("<>")
         if len(token) != 64:
-            response = (
-                "Add the ticket code from your email after the command, like this:  \n"
-                f"`{ self.command.lower().split(maxsplit=1)[0] } a1b2c3d4e5...`"
-                "Token must be 64 characters, check your ticket again or if you "
-                "have trouble, please send an email to helpdesk2020@helpdesk.hope.net"
-            )
+            REDEMPTIONS.inc(ticket_type, "malformed")
+            response = TOKEN_LENGTH_USAGE.format(trigger=self.trigger)
             await send_text_to_room(self.client, self.room.room_id, response)
             return
-        lock = self.config._attendee_token_lock
-        tokens = self.config.tokens
+        backend = self.config.token_backends[ticket_type]
         rooms = self.config.rooms
         group = self.config.community
         if ticket_type == "presenter":
-            lock = self.config._presenter_token_lock
-            tokens = self.config.presenter_tokens
             rooms = self.config.presenter_rooms + self.config.rooms
             group = self.config.presenter_community
         elif ticket_type == "volunteer":
-            lock = self.config._volunteer_token_lock
-            tokens = self.config.volunteer_tokens
             rooms = self.config.volunteer_rooms
             group = self.config.volunteer_community
 
-        # Make sure other tasks don't interfere with our token[] manipulation or writing
-        async with lock:
-            valid, h = valid_token(token, tokens, self.event.sender)
-            if valid:
-                response = (
-                    "Verified ticket. You should now be invited to the HOPE "
-                    f"{ticket_type} chat rooms and community."
-                )
-                await send_text_to_room(self.client, self.room.room_id, response)
-                logger.debug("Inviting %s to %s", self.event.sender, ",".join(rooms))
-                for r in rooms:
-                    await self.client.room_invite(r, self.event.sender)
-                await community_invite(self.client, group, self.event.sender)
-
-                if tokens[h] == "unused":
-                    tokens[h] = self.event.sender
-                return
-            else:
-                logger.info(
-                    "ticket invalid: %s: %s %s (%s)",
-                    self.event.sender,
-                    ticket_type,
-                    token,
-                    tokens.get(h, "<invalid>"),
-                )
-                # notify outside lock block
-        response = (
-            "This is not a valid token, check your ticket again or "
-            "email helpdesk2020@helpdesk.hope.net  \n"
-            "If you are a `volunteer` or `presenter`, use those commands "
-            "instead of `ticket`"
+        # Only hold the lock long enough to claim the token, the invites below
+        # can take a while and shouldn't hold up everyone else
+        async with backend.lock:
+            with span("claim_token", ticket_type=ticket_type):
+                valid, h, previous = claim_token(token, backend, self.event.sender)
+        annotate(ticket_type=ticket_type, valid=valid)
+        REDEMPTIONS.inc(ticket_type, "valid" if valid else "invalid")
+        if valid:
+            response = VERIFIED_TICKET.format(ticket_type=ticket_type)
+            await send_text_to_room(self.client, self.room.room_id, response)
+            logger.debug("Inviting %s to %s", self.event.sender, ",".join(rooms))
+            failed = await self._invite_rooms(rooms, self.event.sender)
+            await community_invite(self.client, group, self.event.sender)
+            if failed and previous == "unused":
+                # Give the token back so the redemption can be retried from scratch
+                async with backend.lock:
+                    release_token(backend, h, self.event.sender, previous)
+            elif previous != self.event.sender:
+                await backend.commit(h, self.event.sender)
+            await self._report_failed_invites(failed)
+            return
+        logger.info(
+            "ticket invalid: %s: %s %s (%s)",
+            self.event.sender,
+            ticket_type,
+            token,
+            previous or "<invalid>",
         )
-        await send_text_to_room(self.client, self.room.room_id, response)
+        await send_text_to_room(self.client, self.room.room_id, INVALID_TOKEN)
 
+    @command("volunteer", req_type="volunteer")
+    @command("oncall", req_type="oncall")
     async def _volunteer_request(self, req_type):
         if len(self.args) != 1:
             return
         if self.args[0] != self.config.volunteer_pass:
-            response = "Sorry, wrong password, try again?"
+            response = WRONG_PASSWORD
             # response = (
             #     "What are you, stoned or stupid? You don't hack a "
             #     "bank across state lines from your house, you'll get nailed "
@@ -191,8 +280,10 @@ class Command(object):
         else:
             response = "Inviting you to the HOPE volunteer rooms..."
             await send_text_to_room(self.client, self.room.room_id, response)
-            for r in self.config.volunteer_rooms:
-                await self.client.room_invite(r, self.event.sender)
+            failed = await self._invite_rooms(
+                self.config.volunteer_rooms, self.event.sender
+            )
+            await self._report_failed_invites(failed)
             await send_text_to_room(
                 self.client,
                 self.room.room_id,
@@ -202,40 +293,37 @@ class Command(object):
                 self.client, self.config.volunteer_community, self.event.sender
             )
 
+    async def _invite_rooms(self, rooms, user):
+        """Invite a user to rooms concurrently, returning the rooms that failed"""
+        return await invite_to_rooms(
+            self.client,
+            rooms,
+            user,
+            self.config.invite_concurrency,
+            self.config.membership,
+        )
+
+    async def _report_failed_invites(self, failed):
+        """Tell the user which rooms we couldn't invite them to"""
+        if not failed:
+            return
+        response = (
+            f"I couldn't invite you to {len(failed)} of the rooms, "
+            "send the same command again in a little while to retry."
+        )
+        await send_text_to_room(self.client, self.room.room_id, response)
+
     async def _show_help(self):
         """Show the help text"""
         if not self.args:
-            text = (
-                "Hello, I'm the HOPE CoreBot! To be invited to the official "
-                "conference channels message me with `ticket <your-token-here>`. "
-                "You can find more information (important for presenters) on the "
-                "[conference bot wiki](https://wiki.hope.net/index.php?title=Conference_bot)."
-            )
-            await send_text_to_room(self.client, self.room.room_id, text)
-
-    async def _the_planet(self):
-        text = "HACK THE PLANET https://youtu.be/YV78vobCyIo?t=55"
-        await send_text_to_room(self.client, self.room.room_id, text)
-
-    async def _trashing(self):
-        text = """They\'re TRASHING our rights, man! They\'re
-        TRASHING the flow of data! They\'re TRASHING!
-        TRASHING! TRASHING! HACK THE PLANET! HACK
-        THE PLANET!"""
-        await send_text_to_room(self.client, self.room.room_id, text)
+            await send_text_to_room(self.client, self.room.room_id, HELP_TEXT)
 
     async def _group(self):
         await send_text_to_room(self.client, self.room.room_id, "inviting to group")
         await community_invite(self.client, self.config, self.event.sender)
 
+    @command("notice", admin=True)
     async def _notice(self):
-        msg = "@room\n" + self.command.split(maxsplit=2)[2]
-        logger.warning(
-            "notice used by %s at %s to send: %r",
-            self.event.sender,
-            self.room.room_id,
-            msg,
-        )
         if len(self.args) < 2:
             await send_text_to_room(
                 self.client,
@@ -243,7 +331,14 @@ class Command(object):
                 "notice args: <room-alias\\> <strings\\>,,,",
             )
             return
-        ret, room_id = await get_roomid(self.client, self.args[0])
+        msg = "@room\n" + self.command.split(maxsplit=2)[2]
+        logger.warning(
+            "notice used by %s at %s to send: %r",
+            self.event.sender,
+            self.room.room_id,
+            msg,
+        )
+        ret, room_id = await get_roomid(self.client, self.config, self.args[0])
         if not ret:
             response = "Could not find a roomid for that room name"
             await send_text_to_room(self.client, self.room.room_id, response)
@@ -251,11 +346,41 @@ class Command(object):
         await send_text_to_room(self.client, room_id, msg, notice=False)
         await send_text_to_room(self.client, self.room.room_id, "Sent")
 
+    @command("sync", admin=True)
     async def _sync(self):
         logger.warning("sync used by %s", self.event.sender)
-        await sync_data(self.config)
-        await send_text_to_room(self.client, self.room.room_id, "Sunk")
+        written = await sync_data(self.config, self.store)
+        response = "Sunk {} changed tables ({} unchanged writes skipped so far)".format(
+            written, self.config.skipped_writes
+        )
+        await send_text_to_room(self.client, self.room.room_id, response)
 
+    @command("reload", admin=True)
+    async def _reload(self):
+        logger.warning("reload used by %s", self.event.sender)
+        count = await load_admins(self.config)
+        await send_text_to_room(
+            self.client, self.room.room_id, f"Reloaded {count} admins"
+        )
+
+    @command("import_tokens", admin=True)
+    async def _import_tokens(self):
+        logger.warning("import_tokens used by %s", self.event.sender)
+        imported = await import_tokens(self.config)
+        response = "Imported {} new tokens ({})".format(
+            sum(imported.values()),
+            ", ".join(f"{t}: {n}" for t, n in imported.items()),
+        )
+        await send_text_to_room(self.client, self.room.room_id, response)
+
+    @command("flush_aliases", admin=True)
+    async def _flush_aliases(self):
+        count = self.config._room_alias_cache.flush()
+        await send_text_to_room(
+            self.client, self.room.room_id, f"Forgot {count} room aliases"
+        )
+
+    @command("invite", admin=True)
     async def _invite(self):
         # manually invite user to a room
         if len(self.args) != 2:
@@ -265,13 +390,14 @@ class Command(object):
             )
             await send_text_to_room(self.client, self.room.room_id, response)
             return
-        ret, room_id = await get_roomid(self.client, self.args[1])
+        ret, room_id = await get_roomid(self.client, self.config, self.args[1])
         if not ret:
             response = "Could not find a roomid for that room name"
             await send_text_to_room(self.client, self.room.room_id, response)
             return
         await self.client.room_invite(room_id, self.args[0])
 
+    @command("invite_group", admin=True)
     async def _invite_group(self):
         # manually invite user to a room
         if len(self.args) != 2:
@@ -291,9 +417,10 @@ class Command(object):
             response = "not a valid group. attendee, volunteer or presenter"
             await send_text_to_room(self.client, self.room.room_id, response)
             return
-        for r in rooms:
-            await self.client.room_invite(r, self.args[0])
+        failed = await self._invite_rooms(rooms, self.args[0])
         response = "invited to {} group".format(self.args[1])
+        if failed:
+            response += "  \nfailed for: {}".format(", ".join(failed))
         await send_text_to_room(self.client, self.room.room_id, response)
 
     async def _join(self):
@@ -305,7 +432,7 @@ class Command(object):
             )
             await send_text_to_room(self.client, self.room.room_id, response)
             return
-        ret, r = await get_roomid(self.client, self.args[0])
+        ret, r = await get_roomid(self.client, self.config, self.args[0])
         if not ret:
             response = "Could not find a roomid for that room name"
             await send_text_to_room(self.client, self.room.room_id, response)
@@ -313,6 +440,7 @@ class Command(object):
         if await is_authed(self.client, self.config, self.event.sender, r):
             print("TODO")
 
+    @command("schedule_announce", admin=True)
     async def _schedule_announcement(self):
         """Add a scheduled announcement
         This does NOT automatically tag @room
@@ -353,7 +481,7 @@ class Command(object):
             return
         # Room
         room = parts[1]
-        ret, room_id = await get_roomid(self.client, room)
+        ret, room_id = await get_roomid(self.client, self.config, room)
         if not ret:
             await send_text_to_room(
                 self.client,
@@ -373,7 +501,7 @@ class Command(object):
         )
 
         await add_announcement(
-            self.config, Announcement(self.client, time, room, message)
+            self.config, Announcement(self.client, self.config, time, room, message)
         )
         await send_text_to_room(
             self.client,
@@ -382,3 +510,36 @@ class Command(object):
                 future.days, future.seconds // (60 * 60), (future.seconds // 60) % 60
             ),
         )
+
+    @command("announcements", admin=True)
+    async def _list_announcements(self):
+        """List the announcements that haven't fired yet"""
+        scheduled = self.config._announcement_scheduler.scheduled()
+        if not scheduled:
+            await send_text_to_room(
+                self.client, self.room.room_id, "No announcements scheduled"
+            )
+            return
+        lines = [
+            "{} {}: {}".format(
+                a.time.astimezone(tz.gettz("America/New_York")).isoformat(),
+                a.room,
+                a.message.splitlines()[0] if a.message else "",
+            )
+            for a in scheduled
+        ]
+        response = f"{len(scheduled)} announcements scheduled:  \n" + "  \n".join(lines)
+        await send_text_to_room(self.client, self.room.room_id, response)
+
+
+THANKS_RE = re.compile(r"\bty\b|\bthx\b|thank|\bthanx\b")
+HI_RE = re.compile(r"\bhi\b|\bhello\b|\bhey\b")
+
+# Tried in order when no trigger matches exactly
+FALLBACK_HANDLERS = [
+    (lambda t: t.startswith("help"), Handler(Command._show_help, False, {})),
+    (lambda t: THANKS_RE.search(t) is not None, Handler(Command._thanks, False, {})),
+    (lambda t: HI_RE.search(t) is not None, Handler(Command._hi, False, {})),
+    # Someone pasting just their ticket code
+    (lambda t: len(t) >= 63, Handler(Command._just_token, False, {})),
+]
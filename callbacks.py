@@ -1,11 +1,12 @@
 # coding=utf-8
 
-from asyncio import create_task
 import logging
 
 from nio import JoinError
 
+from bot_actions import is_admin
 from bot_commands import Command
+from dedup import EventDeduplicator
 from message_responses import Message
 
 logger = logging.getLogger(__name__)
@@ -25,6 +26,13 @@ class Callbacks(object):
         self.store = store
         self.config = config
         self.command_prefix = config.command_prefix
+        self.dedup = EventDeduplicator(
+            store, config.dedup_capacity, config.dedup_max_age
+        )
+        # The sync token is saved, or the transaction acknowledged, before
+        # commands run, so dropped ones usually won't come again. They are
+        # logged for admins to follow up, and forgotten in case they do.
+        config.command_executor.on_dropped = self._dropped
 
     async def message(self, room, event):
         """Callback for when a message event is received
@@ -38,8 +46,8 @@ class Callbacks(object):
         # Extract the message text
         msg = event.body
 
-        # Ignore messages from ourselves
-        if event.sender == self.client.user:
+        # Ignore messages from ourselves, and ones too old to still want an answer
+        if event.sender == self.client.user or self.dedup.too_old(event):
             return
 
         logger.debug(
@@ -62,8 +70,33 @@ class Callbacks(object):
             msg = msg[len(self.command_prefix) :]
 
         command = Command(self.client, self.store, self.config, msg, room, event)
-        # Spawn a task and don't wait for it
-        create_task(command.process())
+        handler = command.find_handler()
+        if handler is None:
+            return
+        # Commands come round again after reconnects and full state syncs
+        if self.dedup.seen(event):
+            return
+        # Queue it for the command workers. Admin commands from admins skip the
+        # queue, anyone else trying them waits in line to be turned down
+        priority = handler.admin and await is_admin(self.config, event.sender)
+        await self.config.command_executor.submit(command, priority=priority)
+
+    def _dropped(self, command):
+        logger.warning(
+            "Command %r from %s in event %s was not run",
+            command.command,
+            command.event.sender,
+            command.event.event_id,
+        )
+        self.dedup.forget(command.event)
+
+    async def sync(self, response):
+        """Callback for each sync response, remembers where to resume syncing from
+
+        Args:
+            response (nio.responses.SyncResponse): The sync response
+        """
+        self.store.save_sync_token(response.next_batch)
 
     async def invite(self, room, event):
         """Callback for when an invite is received. Join the room specified in the invite"""
@@ -1,12 +1,18 @@
 # coding=utf-8
 
+from functools import lru_cache
 import logging
 
 from markdown import markdown
 from nio import SendRetryError
 
+from tracing import span
+
 logger = logging.getLogger(__name__)
 
+# Canned responses, rendered once by prerender
+_static_renders = {}
+
 
 async def send_text_to_room(
     client, room_id, message, notice=True, markdown_convert=True
@@ -26,6 +32,13 @@ async def send_text_to_room(
         markdown_convert (bool): Whether to convert the message content to markdown.
             Defaults to true.
     """
+    with span("send_text_to_room", room=room_id):
+        content = make_text_content(message, notice, markdown_convert)
+        await send_content_to_room(client, room_id, content)
+
+
+def make_text_content(message, notice=True, markdown_convert=True):
+    """Build the content of a text message, see send_text_to_room"""
     # Determine whether to ping room members or not
     msgtype = "m.notice" if notice else "m.text"
 
@@ -36,8 +49,37 @@ async def send_text_to_room(
     }
 
     if markdown_convert:
-        content["formatted_body"] = markdown(message)
+        content["formatted_body"] = render_markdown(message)
+
+    return content
+
+
+def render_markdown(message):
+    """Render a message to HTML, reusing earlier renders where possible"""
+    rendered = _static_renders.get(message)
+    if rendered is None:
+        rendered = _render_dynamic(message)
+    return rendered
+
+
+@lru_cache(maxsize=1024)
+def _render_dynamic(message):
+    return markdown(message)
+
+
+def prerender(messages):
+    """Render messages that will be sent over and over ahead of time
+
+    Args:
+        messages (list): The messages, exactly as they will be sent
+    """
+    for message in messages:
+        _static_renders[message] = markdown(message)
+    logger.debug("Prerendered %d messages", len(_static_renders))
+
 
+async def send_content_to_room(client, room_id, content):
+    """Send message content made by make_text_content to a matrix room"""
     try:
         await client.room_send(
             room_id, "m.room.message", content, ignore_unverified_devices=True,
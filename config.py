@@ -1,7 +1,5 @@
 # coding=utf-8
 
-from asyncio import Lock
-import csv
 import logging
 import os
 import re
@@ -11,6 +9,9 @@ from typing import Any, List
 import yaml
 
 from errors import ConfigError
+from metrics import TimedLock
+from room_aliases import RoomAliasCache
+from scheduler import AnnouncementScheduler
 
 logger = logging.getLogger()
 
@@ -117,33 +118,24 @@ class Config(object):
         self.admin_csv_path = self._get_cfg(
             ["admin_csv"], default="data/admin.csv", required=False,
         )
+        # Seconds between checks of the admin csv for changes
+        self.admin_recheck_interval = float(
+            self._get_cfg(["admin_recheck_interval"], default=10, required=False,)
+        )
+        # Loaded on first use by bot_actions.is_admin, on the disk I/O thread
+        self._admins = set()
+        self._admins_mtime = None
+        self._admins_checked = float("-inf")
 
         self.oncall_room = self._get_cfg(["oncall_room"], required=False)
-        with open(self.tokens_path, "r") as f:
-            reader = csv.reader(f)
-            self.tokens = dict(reader)
         with open(self.rooms_path, "r") as f:
             self.rooms = f.read().splitlines()
-        try:
-            with open(self.volunteer_tokens_path, "r") as f:
-                reader = csv.reader(f)
-                self.volunteer_tokens = dict(reader)
-        except FileNotFoundError:
-            logger.error("No volunteers csv")
-            self.volunteer_tokens = {}
         try:
             with open(self.volunteer_rooms_path, "r") as f:
                 self.volunteer_rooms = f.read().splitlines()
         except FileNotFoundError:
             logger.error("No volunteer_rooms csv")
             self.volunteer_rooms = []
-        try:
-            with open(self.presenter_tokens_path, "r") as f:
-                reader = csv.reader(f)
-                self.presenter_tokens = dict(reader)
-        except FileNotFoundError:
-            logger.error("No presenters csv")
-            self.presenter_tokens = {}
         try:
             with open(self.presenter_rooms_path, "r") as f:
                 self.presenter_rooms = f.read().splitlines()
@@ -151,19 +143,173 @@ class Config(object):
             logger.error("No presenter_rooms csv")
             self.presenter_rooms = []
 
+        self.invite_concurrency = int(
+            self._get_cfg(["invite_concurrency"], default=8, required=False,)
+        )
+        # Who is already in which room, set up with the client in main
+        self.membership = None
+
+        # Pacing of messages and invites sent to the homeserver, see OutboundQueue.
+        # By default two users' invites can all be in flight at once
+        self.outbound_workers = int(
+            self._get_cfg(
+                ["outbound", "workers"],
+                default=2 * self.invite_concurrency,
+                required=False,
+            )
+        )
+        self.outbound_rate = float(
+            self._get_cfg(["outbound", "rate"], default=50, required=False)
+        )
+        self.outbound_burst = int(
+            self._get_cfg(["outbound", "burst"], default=100, required=False)
+        )
+        self.outbound_room_rate = float(
+            self._get_cfg(["outbound", "room_rate"], default=1, required=False)
+        )
+        self.outbound_room_burst = int(
+            self._get_cfg(["outbound", "room_burst"], default=5, required=False)
+        )
+        self.outbound_max_retries = int(
+            self._get_cfg(["outbound", "max_retries"], default=5, required=False)
+        )
+
+        self._room_alias_cache = RoomAliasCache(
+            float(self._get_cfg(["alias_cache_ttl"], default=3600, required=False)),
+            float(
+                self._get_cfg(["alias_cache_negative_ttl"], default=60, required=False)
+            ),
+        )
+
+        # Filtering of what the homeserver sends us, see bot_actions.build_sync_filter
+        self.sync_filter_enabled = self._get_cfg(
+            ["sync_filter", "enabled"], default=True, required=False
+        )
+        self.sync_filter_lazy_load_members = self._get_cfg(
+            ["sync_filter", "lazy_load_members"], default=True, required=False
+        )
+        self.sync_filter_timeline_limit = int(
+            self._get_cfg(["sync_filter", "timeline_limit"], default=20, required=False)
+        )
+        self.sync_filter_broadcast_rooms = self._get_cfg(
+            ["sync_filter", "broadcast_rooms"], default=[], required=False
+        )
+
+        # Commands run on a pool of workers with a bounded queue
+        self.command_workers = int(
+            self._get_cfg(["command_workers"], default=16, required=False)
+        )
+        self.command_queue_size = int(
+            self._get_cfg(["command_queue_size"], default=1000, required=False)
+        )
+        # Seconds to let running commands finish when shutting down
+        self.shutdown_timeout = float(
+            self._get_cfg(["shutdown_timeout"], default=10, required=False)
+        )
+        # Optional Prometheus endpoint
+        self.metrics_enabled = self._get_cfg(
+            ["metrics", "enabled"], default=False, required=False
+        )
+        self.metrics_host = self._get_cfg(
+            ["metrics", "host"], default="127.0.0.1", required=False
+        )
+        self.metrics_port = int(
+            self._get_cfg(["metrics", "port"], default=9191, required=False)
+        )
+
+        # Where to record received events for benchmarks/replay.py, off if unset
+        self.record_path = self._get_cfg(["record", "path"], required=False)
+
+        # Remembering which commands have been processed, see EventDeduplicator
+        self.dedup_capacity = int(
+            self._get_cfg(["event_dedup", "capacity"], default=10000, required=False)
+        )
+        self.dedup_max_age = float(
+            self._get_cfg(["event_dedup", "max_age"], default=3600, required=False)
+        )
+
+        # Command tracing, see tracing.Tracer
+        self.trace_path = self._get_cfg(["tracing", "path"], required=False)
+        self.trace_sample_rate = float(
+            self._get_cfg(["tracing", "sample_rate"], default=0, required=False)
+        )
+        self.trace_slow_threshold = float(
+            self._get_cfg(["tracing", "slow_threshold"], default=10, required=False)
+        )
+
+        # Application service mode, where events are pushed to the bot instead
+        # of it syncing
+        self.appservice_enabled = self._get_cfg(
+            ["appservice", "enabled"], default=False, required=False
+        )
+        self.appservice_host = self._get_cfg(
+            ["appservice", "host"], default="127.0.0.1", required=False
+        )
+        self.appservice_port = int(
+            self._get_cfg(["appservice", "port"], default=8090, required=False)
+        )
+        self.appservice_as_token = self._get_cfg(
+            ["appservice", "as_token"], required=False
+        )
+        self.appservice_hs_token = self._get_cfg(
+            ["appservice", "hs_token"], required=False
+        )
+        if self.appservice_enabled and not (
+            self.appservice_as_token and self.appservice_hs_token
+        ):
+            raise ConfigError("appservice needs an as_token and an hs_token")
+        # The listener when running as an application service, set up in main
+        self.appservice = None
+
+        # Seconds to wait before reconnecting, doubling with each failure
+        self.reconnect_initial_delay = float(
+            self._get_cfg(["reconnect", "initial_delay"], default=1, required=False)
+        )
+        self.reconnect_max_delay = float(
+            self._get_cfg(["reconnect", "max_delay"], default=300, required=False)
+        )
+
         self.sync_interval = int(
             self._get_cfg(["sync_interval"], default=300, required=False,)
         )
+        # Seconds between checks of the token csvs for new tokens, 0 for only when
+        # asked to with import_tokens
+        self.token_watch_interval = float(
+            self._get_cfg(["token_watch_interval"], default=0, required=False)
+        )
 
         self._announcements = []
         self.announcement_csv = self._get_cfg(
             ["announcement_csv"], default="data/announcements.csv", required=False,
         )
-        self._announcement_lock = Lock()
+        self._announcement_lock = TimedLock("announcements")
+        # Seconds before an announcement to look up its room and render it
+        self.announcement_lead_time = float(
+            self._get_cfg(["announcement_lead_time"], default=60, required=False,)
+        )
+        self._announcement_scheduler = AnnouncementScheduler(
+            self.announcement_lead_time
+        )
+
+        # These record how long they are waited on, see metrics.LOCK_WAIT
+        self._attendee_token_lock = TimedLock("attendee")
+        self._presenter_token_lock = TimedLock("presenter")
+        self._volunteer_token_lock = TimedLock("volunteer")
 
-        self._attendee_token_lock = Lock()
-        self._presenter_token_lock = Lock()
-        self._volunteer_token_lock = Lock()
+        # Where tokens are kept, csv or sqlite. The backends themselves are set
+        # up once storage is available, see token_backends.load_token_backends
+        self.token_backend = self._get_cfg(
+            ["token_backend"], default="csv", required=False,
+        )
+        if self.token_backend not in ("csv", "sqlite"):
+            raise ConfigError("token_backend must be csv or sqlite")
+        self.token_backends = {}
+        # Seconds to batch up redemptions before writing them to the journal
+        self.journal_commit_delay = float(
+            self._get_cfg(["journal_commit_delay"], default=0.01, required=False,)
+        )
+        # Token table writes skipped because nothing had changed
+        self.skipped_writes = 0
 
     def _get_cfg(
         self, path: List[str], default: Any = None, required: bool = True,
@@ -171,6 +317,9 @@ class Config(object):
         """Get a config option from a path and option name, specifying whether it is
         required.
 
+        Only a default of None means there is no default, so falsy defaults like
+        False, 0 and [] are returned when the option is missing.
+
         Raises:
             ConfigError: If required is specified and the object is not found
                 (and there is no default value provided), this error will be raised
@@ -183,7 +332,7 @@ class Config(object):
             # If at any point we don't get our expected option...
             if config is None:
                 # Raise an error if it was required
-                if required or not default:
+                if required and default is None:
                     raise ConfigError(f"Config option {'.'.join(path)} is required")
 
                 # or return the default value
@@ -0,0 +1,79 @@
+# coding=utf-8
+
+from collections import OrderedDict
+import logging
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class EventDeduplicator(object):
+    def __init__(self, store, capacity=10000, max_age=3600):
+        """Remembers which events have been acted on, so they are only acted on once
+
+        Events come round again after a reconnect or a full state sync. Recent
+        event IDs are kept in memory, and all of them are kept in the database
+        until they are too old to matter, as events older than max_age are
+        dropped without looking them up at all.
+
+        Args:
+            store (Storage): Where processed event IDs are kept
+
+            capacity (int): How many event IDs to keep in memory
+
+            max_age (float): Seconds after which an event is too old to act on,
+                0 to act on events of any age
+        """
+        self.store = store
+        self.capacity = capacity
+        self.max_age = max_age
+        self.duplicates = 0
+        self.expired = 0
+        self._recent = OrderedDict()
+        self._marked = 0
+
+    def too_old(self, event):
+        """Check whether an event is older than max_age"""
+        if not self.max_age:
+            return False
+        age = time() - event.server_timestamp / 1000
+        if age > self.max_age:
+            self.expired += 1
+            logger.debug("Dropping %s, it is %.0fs old", event.event_id, age)
+            return True
+        return False
+
+    def seen(self, event):
+        """Check whether an event has been processed, and mark it if it hasn't
+
+        Returns:
+            bool: True if the event should be skipped
+        """
+        event_id = event.event_id
+        if event_id in self._recent:
+            self._recent.move_to_end(event_id)
+            self.duplicates += 1
+            logger.debug("Skipping %s, already processed", event_id)
+            return True
+        duplicate = self.store.is_event_processed(event_id)
+        if duplicate:
+            self.duplicates += 1
+            logger.debug("Skipping %s, processed before a restart", event_id)
+        else:
+            self.store.mark_event_processed(event_id, event.server_timestamp)
+            self._marked += 1
+            if self.max_age and self._marked % 1000 == 0:
+                pruned = self.store.prune_processed_events(
+                    (time() - self.max_age) * 1000
+                )
+                logger.debug("Forgot %d old processed events", pruned)
+        self._recent[event_id] = True
+        if len(self._recent) > self.capacity:
+            self._recent.popitem(last=False)
+        return duplicate
+
+    def forget(self, event):
+        """Unmark an event that was never acted on, so it is if it comes again"""
+        self._recent.pop(event.event_id, None)
+        self.store.unmark_event_processed(event.event_id)
+        logger.debug("Forgot %s, it was not processed", event.event_id)
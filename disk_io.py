@@ -0,0 +1,95 @@
+# coding=utf-8
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from functools import partial
+import io
+import logging
+from os import fsync, rename
+
+logger = logging.getLogger(__name__)
+
+# One thread, so writes happen in the order they were submitted in
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk-io")
+
+
+async def run_io(func, *args):
+    """Run a blocking file operation on the disk I/O thread and wait for it
+
+    Operations run one at a time, in the order they were submitted.
+
+    Returns:
+        Whatever func returns
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args))
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Disk I/O failed", exc_info=future.exception())
+
+
+def submit_io(func, *args):
+    """Queue a blocking file operation on the disk I/O thread without waiting
+
+    For writes nothing needs to wait on, failures are logged.
+
+    Returns:
+        asyncio.Future: Resolves when the operation is done
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(_executor, partial(func, *args))
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def write_csv_atomic(path, rows, keep_from=None):
+    """Replace a csv file with rows, so it is never seen half written
+
+    Args:
+        path (str): The file to replace
+
+        rows (iterable): The rows to write
+
+        keep_from (int): Byte offset in the current file to keep everything
+            after, following the new rows. Bytes appended to the current file
+            while the new one is being written are carried over too. None to
+            keep nothing.
+
+    Returns:
+        int: The size of the new rows, where anything kept starts
+    """
+    buf = io.StringIO()
+    csv_writer = csv.writer(buf)
+    csv_writer.writerows(rows)
+    data = buf.getvalue().encode("utf-8")
+    old = None
+    if keep_from is not None:
+        try:
+            old = open(path, "rb")
+            old.seek(keep_from)
+        except FileNotFoundError:
+            pass
+    try:
+        filename_temp = path + ".atomic"
+        with open(filename_temp, "wb") as f:
+            f.write(data)
+            if old is not None:
+                f.write(old.read())
+            f.flush()
+            fsync(f.fileno())
+        rename(filename_temp, path)
+        if old is not None:
+            # Anything written to the old file up to the rename
+            late = old.read()
+            if late:
+                with open(path, "ab") as f:
+                    f.write(late)
+                    f.flush()
+                    fsync(f.fileno())
+    finally:
+        if old is not None:
+            old.close()
+    return len(data)
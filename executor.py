@@ -0,0 +1,149 @@
+# coding=utf-8
+
+import asyncio
+from collections import deque
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CommandExecutor(object):
+    def __init__(self, workers=16, max_queue=1000, on_dropped=None):
+        """Runs commands on a fixed number of workers
+
+        Commands wait in one of two lanes. The priority lane, for admin commands,
+        is always served first so they don't queue behind a flood of ticket
+        redemptions. The normal lane is bounded, and submitting to it waits for
+        space when it is full.
+
+        Args:
+            workers (int): How many commands can run at once
+
+            max_queue (int): How many commands can wait in the normal lane
+
+            on_dropped (callable): Called with each command that won't be run
+                after all: turned away while shutting down, still queued when
+                draining gave up, or cancelled part way through
+        """
+        self.workers = workers
+        self.on_dropped = on_dropped
+        self._priority = deque()
+        self._normal = deque()
+        self._ready = asyncio.Semaphore(0)
+        self._space = asyncio.Semaphore(max_queue)
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closing = False
+        self._tasks = []
+
+    @property
+    def depth(self):
+        """Commands waiting to run"""
+        return len(self._priority) + len(self._normal)
+
+    @property
+    def in_flight(self):
+        """Commands running now"""
+        return self._pending - self.depth
+
+    def start(self):
+        """Start the workers, must be called from the event loop"""
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._worker()) for _ in range(self.workers)
+            ]
+
+    async def submit(self, command, priority=False):
+        """Queue a command to be processed
+
+        Args:
+            command (Command): The command to run
+
+            priority (bool): Whether to put it in the priority lane
+
+        Returns:
+            bool: Whether the command was queued, False once shutting down
+        """
+        if self._closing:
+            logger.warning("Shutting down, dropping command %r", command.command)
+            self._dropped(command)
+            return False
+        if not priority:
+            await self._space.acquire()
+            if self._closing:
+                # Started shutting down while waiting for space
+                self._space.release()
+                self._dropped(command)
+                return False
+            self._normal.append(command)
+        else:
+            self._priority.append(command)
+        self._pending += 1
+        self._idle.clear()
+        self._ready.release()
+        return True
+
+    async def drain(self, timeout):
+        """Stop taking commands and wait for the queued ones to finish
+
+        Args:
+            timeout (float): Seconds to wait before cancelling whatever is left
+
+        Returns:
+            bool: Whether everything finished in time
+        """
+        self._closing = True
+        logger.info(
+            "Draining %d queued and %d running commands", self.depth, self.in_flight
+        )
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            finished = True
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Gave up on %d queued and %d running commands",
+                self.depth,
+                self.in_flight,
+            )
+            finished = False
+        while self._priority:
+            self._pending -= 1
+            self._dropped(self._priority.popleft())
+        while self._normal:
+            self._pending -= 1
+            self._space.release()
+            self._dropped(self._normal.popleft())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        return finished
+
+    def _dropped(self, command):
+        if self.on_dropped is None:
+            return
+        try:
+            self.on_dropped(command)
+        except Exception:
+            logger.exception("Error dropping command %r", command.command)
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            if self._priority:
+                command = self._priority.popleft()
+            else:
+                command = self._normal.popleft()
+                self._space.release()
+            try:
+                await command.process()
+            except asyncio.CancelledError:
+                self._dropped(command)
+                raise
+            except Exception:
+                logger.exception("Error processing command %r", command.command)
+            finally:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.set()
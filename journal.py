@@ -0,0 +1,152 @@
+# coding=utf-8
+
+import asyncio
+import csv
+import logging
+from os import fsync, rename
+
+from disk_io import run_io
+
+logger = logging.getLogger(__name__)
+
+
+def _append_rows(path, rows):
+    with open(path, "a", newline="") as f:
+        csv_writer = csv.writer(f, lineterminator="\n")
+        csv_writer.writerows(rows)
+        f.flush()
+        fsync(f.fileno())
+
+
+def _drop_lines(path, count):
+    """Remove the first count lines of a file, keeping the rest"""
+    try:
+        with open(path, "r", newline="") as f:
+            lines = f.read().split("\n")[count:]
+    except FileNotFoundError:
+        return
+    filename_temp = path + ".atomic"
+    with open(filename_temp, "w", newline="") as f:
+        f.write("\n".join(lines))
+        f.flush()
+        fsync(f.fileno())
+    rename(filename_temp, path)
+
+
+class Journal(object):
+    def __init__(self, path, commit_delay=0.01):
+        """An append-only log of token redemptions
+
+        Redemptions are written here as they happen and folded into the token csv
+        snapshot by write_csv, which then drops the entries the snapshot covers.
+        On startup the journal is replayed on top of the snapshot. All file
+        access after that happens on the disk I/O thread.
+
+        Args:
+            path (str): Path of the journal file
+
+            commit_delay (float): How long to collect appends before writing and
+                fsyncing them together as a single batch
+        """
+        self.path = path
+        self.commit_delay = commit_delay
+        self._pending = []
+        self._commit_task = None
+        self._lock = asyncio.Lock()
+        # Lines ever written and lines since dropped from the front of the file,
+        # so marks stay valid whatever order truncates happen in
+        self._written = 0
+        self._dropped = 0
+
+    def replay(self, tokens):
+        """Apply the journalled redemptions to a token table
+
+        Args:
+            tokens (dict): The token table loaded from the snapshot csv
+
+        Returns:
+            int: The number of entries applied
+        """
+        try:
+            with open(self.path, "r", newline="") as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return 0
+        # The last line is either empty or was cut short by a crash mid-write
+        if lines[-1]:
+            logger.warning("Dropping incomplete journal entry in %s", self.path)
+            with open(self.path, "w", newline="") as f:
+                f.write("".join(line + "\n" for line in lines[:-1]))
+                f.flush()
+                fsync(f.fileno())
+        lines = lines[:-1]
+        self._written = len(lines)
+        applied = 0
+        for row in csv.reader(lines):
+            if len(row) != 2:
+                logger.warning("Skipping bad journal entry in %s: %r", self.path, row)
+                continue
+            digest, holder = row
+            if digest not in tokens:
+                logger.warning("Journal entry for unknown token %s", digest)
+                continue
+            tokens[digest] = holder
+            applied += 1
+        logger.info("Replayed %d entries from %s", applied, self.path)
+        return applied
+
+    async def append(self, digest, holder):
+        """Record that a token is now held by holder
+
+        Returns once the entry is on disk. Appends made close together are
+        written and fsynced as one batch.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((digest, holder, future))
+        if self._commit_task is None:
+            self._commit_task = asyncio.create_task(self._commit_later())
+        await future
+
+    async def _commit_later(self):
+        await asyncio.sleep(self.commit_delay)
+        self._commit_task = None
+        await self.commit()
+
+    async def commit(self):
+        """Write out any pending entries"""
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            rows = [(digest, holder) for digest, holder, _ in batch]
+            try:
+                await run_io(_append_rows, self.path, rows)
+                self._written += len(rows)
+            except OSError:
+                # The next snapshot will still pick these up from memory
+                logger.exception("Unable to write %d journal entries", len(batch))
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+            logger.debug("Committed %d journal entries", len(batch))
+
+    def mark(self):
+        """Get how far the journal goes, to pass to truncate later
+
+        Call when taking a snapshot. Every entry up to here is for a redemption
+        the snapshot already has. Entries still being written aren't counted, so
+        they are kept until a later snapshot.
+        """
+        return self._written
+
+    async def truncate(self, mark):
+        """Drop the entries up to mark once a snapshot with them has been written
+
+        Entries written since mark are kept, they may not be in the snapshot. A
+        mark older than one already truncated to does nothing.
+        """
+        count = mark - self._dropped
+        if count <= 0:
+            return
+        self._dropped = mark
+        await run_io(_drop_lines, self.path, count)
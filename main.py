@@ -6,50 +6,97 @@ import csv
 import logging
 from signal import SIGINT, SIGTERM
 import sys
-from time import sleep
+from time import monotonic
 
-from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
-    AsyncClient,
     AsyncClientConfig,
     InviteMemberEvent,
-    LocalProtocolError,
-    LoginError,
+    RoomMemberEvent,
     RoomMessageText,
+    SyncResponse,
 )
 
-from bot_actions import add_announcement, Announcement, periodic_sync, sync_data
+from appservice import AppServiceServer
+from bot_actions import (
+    add_announcement,
+    Announcement,
+    periodic_sync,
+    start_background,
+    sync_data,
+    warm_room_aliases,
+    watch_tokens,
+)
+from bot_commands import STATIC_RESPONSES
 from callbacks import Callbacks
+from chat_functions import prerender
 from config import Config
+from executor import CommandExecutor
+from membership import MembershipIndex
+import metrics
+from outbound import OutboundQueue, QueuedAsyncClient
+from recorder import EventRecorder
 from storage import Storage
+from supervisor import ConnectionSupervisor
+from token_backends import load_token_backends
+import tracing
 
 logger = logging.getLogger(__name__)
 
 
-async def shutdown(loop, client, config, signal=None):
+async def shutdown(loop, client, config, store, signal=None):
     if getattr(config, "stopping", False):
         return
     config.stopping = True
     logger.info("Shutting down for %s", signal.name if signal else "command")
+    # Stop taking transactions first, ones we don't acknowledge are sent again
+    # after a restart
+    if config.appservice is not None:
+        await config.appservice.stop()
+    # Let commands that are already running finish before saving tokens
+    await config.command_executor.drain(config.shutdown_timeout)
+    await client.outbound.stop()
+    if config.metrics_server is not None:
+        await config.metrics_server.stop()
     await client.close()
+    if config.recorder is not None:
+        config.recorder.close()
     config.sync_task.cancel()
-    await sync_data(config)
+    if config.token_watch_task is not None:
+        config.token_watch_task.cancel()
+    await config._announcement_scheduler.stop()
+    await sync_data(config, store)
     loop.stop()
     logger.info("Goodbye")
 
 
+async def report_ready(client, started):
+    """Log how long it took to be up to date with the homeserver"""
+    await client.synced.wait()
+    logger.info("Ready %.1fs after starting", monotonic() - started)
+
+
 async def main():
     # Read config file
 
+    started = monotonic()
+
     # A different config file path can be specified as the first command line argument
-    if len(sys.argv) > 1:
-        config_filepath = sys.argv[1]
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if args:
+        config_filepath = args[0]
     else:
         config_filepath = "data/config.yaml"
+    # Syncing resumes from where it left off unless --full-state is given
+    full_state = "--full-state" in sys.argv
     config = Config(config_filepath)
+    prerender(STATIC_RESPONSES)
+    tracing.configure(
+        config.trace_path, config.trace_sample_rate, config.trace_slow_threshold
+    )
 
     # Configure the database
     store = Storage(config.database_filepath)
+    config.token_backends = load_token_backends(config, store)
 
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
@@ -59,13 +106,26 @@ async def main():
         encryption_enabled=True,
     )
 
+    # Messages and invites are paced through a queue so the homeserver's rate
+    # limits don't make us drop them
+    outbound = OutboundQueue(
+        workers=config.outbound_workers,
+        rate=config.outbound_rate,
+        burst=config.outbound_burst,
+        room_rate=config.outbound_room_rate,
+        room_burst=config.outbound_room_burst,
+        max_retries=config.outbound_max_retries,
+    )
+    outbound.start()
+
     # Initialize the matrix client
-    client = AsyncClient(
+    client = QueuedAsyncClient(
         config.homeserver_url,
         config.user_id,
         device_id=config.device_id,
         store_path=config.store_filepath,
         config=client_config,
+        outbound=outbound,
     )
 
     # Signal handlers
@@ -73,16 +133,64 @@ async def main():
     for sig in (SIGINT, SIGTERM):
         loop.add_signal_handler(
             sig,
-            lambda sig=sig: asyncio.create_task(shutdown(loop, client, config, sig)),
+            lambda sig=sig: asyncio.create_task(
+                shutdown(loop, client, config, store, sig)
+            ),
+        )
+
+    # Commands are run by a pool of workers
+    config.command_executor = CommandExecutor(
+        workers=config.command_workers, max_queue=config.command_queue_size
+    )
+    config.command_executor.start()
+
+    metrics.OUTBOUND_DEPTH.func = lambda: outbound.depth
+    metrics.COMMAND_QUEUE_DEPTH.func = lambda: config.command_executor.depth
+    config.metrics_server = None
+    if config.metrics_enabled:
+        config.metrics_server = metrics.MetricsServer(
+            config.metrics_host, config.metrics_port
         )
+        await config.metrics_server.start()
+
+    # Record events before handling them, so their timing isn't held up by a
+    # full command queue
+    config.recorder = None
+    if config.record_path:
+        config.recorder = EventRecorder(
+            config.record_path, config.user_id, secrets=[config.volunteer_pass]
+        )
+        client.add_event_callback(config.recorder.message, (RoomMessageText,))
+        client.add_event_callback(config.recorder.invite, (InviteMemberEvent,))
 
     # Set up event callbacks
     callbacks = Callbacks(client, store, config)
     client.add_event_callback(callbacks.message, (RoomMessageText,))
     client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
+    client.add_response_callback(callbacks.sync, (SyncResponse,))
+
+    # Rooms people are already in are skipped when inviting them
+    config.membership = MembershipIndex(client)
+    client.add_event_callback(config.membership.member, (RoomMemberEvent,))
+
+    if config.appservice_enabled:
+        # Requests are made as the application service instead of a logged in
+        # device
+        client.access_token = config.appservice_as_token
+        client.user_id = config.user_id
+    elif full_state:
+        logger.info("Doing a full state sync")
+    else:
+        client.next_batch = store.get_sync_token()
+        if client.next_batch:
+            logger.info("Resuming sync from %s", client.next_batch)
 
     # Periodic token save
-    config.sync_task = asyncio.create_task(periodic_sync(config))
+    config.sync_task = asyncio.create_task(periodic_sync(config, store))
+    # Pick up tokens added to the csvs while running
+    config.token_watch_task = None
+    if config.token_watch_interval:
+        config.token_watch_task = asyncio.create_task(watch_tokens(config))
 
     # Schedule announcements
     try:
@@ -91,55 +199,33 @@ async def main():
             for record in reader:
                 await add_announcement(
                     config,
-                    Announcement(client, record[0], record[1], record[2]),
+                    Announcement(client, config, record[0], record[1], record[2]),
                     write=False,
                 )
     except FileNotFoundError:
         logger.error("No announcements csv")
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        logger.debug("Starting client")
-        try:
-            # Try to login with the configured username/password
-            try:
-                login_response = await client.login(
-                    password=config.user_password, device_name=config.device_name,
-                )
-
-                # Check if login failed
-                if type(login_response) == LoginError:
-                    logger.error("Failed to login: %s", login_response.message)
-                    return False
-            except LocalProtocolError as e:
-                # There's an edge case here where the user hasn't installed the correct C
-                # dependencies. In that case, a LocalProtocolError is raised on login.
-                logger.fatal(
-                    "Failed to login. Have you installed the correct dependencies? "
-                    "https://github.com/poljar/matrix-nio#installation "
-                    "Error: %s",
-                    e,
-                )
-                return False
-
-            # Login succeeded!
-
-            # Sync encryption keys with the server
-            # Required for participating in encrypted rooms
-            if client.should_upload_keys:
-                await client.keys_upload()
-
-            logger.info(f"Logged in as {config.user_id}")
-            await client.sync_forever(timeout=30000, full_state=True)
+    if config.appservice_enabled:
+        # The homeserver pushes events to us, so there is nothing to sync
+        config.appservice = AppServiceServer(
+            client,
+            config.appservice_hs_token,
+            host=config.appservice_host,
+            port=config.appservice_port,
+        )
+        start_background(warm_room_aliases(client, config), "warming room aliases")
+        return await config.appservice.run()
 
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
+    start_background(report_ready(client, started), "reporting ready")
 
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
+    # Keep trying to reconnect on failure, backing off between attempts
+    config.supervisor = ConnectionSupervisor(
+        client,
+        config,
+        initial_delay=config.reconnect_initial_delay,
+        max_delay=config.reconnect_max_delay,
+    )
+    return await config.supervisor.run(full_state=full_state)
 
 
 asyncio.get_event_loop().run_until_complete(main())
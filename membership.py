@@ -0,0 +1,43 @@
+# coding=utf-8
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MembershipIndex(object):
+    def __init__(self, client):
+        """Answers whether a user is already in (or invited to) a room
+
+        Uses the room state the client has synced, plus the invites the bot has
+        sent since, which only show up in the room state after the next sync.
+        With lazy loading of members the synced state doesn't list everyone, so
+        a user missing from it may still be in the room. In that case they get
+        invited and the homeserver says they are already there.
+
+        Args:
+            client (nio.AsyncClient): The client whose room state to use
+        """
+        self.client = client
+        self.skipped = 0
+        self._invited = set()
+
+    def is_member(self, room_id, user_id):
+        """Check whether a user is known to be joined or invited to a room"""
+        room = self.client.rooms.get(room_id)
+        if room is not None and user_id in room.users:
+            return True
+        return (room_id, user_id) in self._invited
+
+    def invited(self, room_id, user_id):
+        """Record that a user has been invited to a room, or was already in it"""
+        self._invited.add((room_id, user_id))
+
+    async def member(self, room, event):
+        """Callback for membership events
+
+        Once the room state has caught up with an invite it no longer needs to be
+        remembered here, and users who leave or are banned have to be invited
+        again.
+        """
+        self._invited.discard((room.room_id, event.state_key))
@@ -0,0 +1,265 @@
+# coding=utf-8
+
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+from time import monotonic
+
+from aiohttp import web
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast cache hit up to a redemption stuck behind rate limits
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        """A metric exposed in the Prometheus text format
+
+        Args:
+            name (str): The metric name
+
+            documentation (str): Shown as the metric's HELP line
+
+            labels (tuple): The label names, values are given when recording
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _samples(self):
+        for values, value in sorted(self._values.items()):
+            yield self.name, _format_labels(self.labels, values), value
+
+    def render(self):
+        """Get the metric in the Prometheus text format
+
+        Returns:
+            list: The lines for this metric
+        """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self._samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), func=None):
+        """A value that goes up and down
+
+        Args:
+            func (callable): Called when scraped to get the value of a gauge with
+                no labels, instead of it being set
+        """
+        super(Gauge, self).__init__(name, documentation, labels)
+        self.func = func
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def _samples(self):
+        if self.func is not None:
+            yield self.name, "", self.func()
+            return
+        yield from super(Gauge, self)._samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, *labels):
+        counts, total = self._values.get(labels, (None, 0))
+        if counts is None:
+            counts = [0] * len(self.buckets)
+        counts[bisect_left(self.buckets, value)] += 1
+        self._values[labels] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe how long the with block takes"""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, *labels)
+
+    def _samples(self):
+        for values, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = ("le", _format_value(bound))
+                yield (
+                    f"{self.name}_bucket",
+                    _format_labels(self.labels, values, le),
+                    cumulative,
+                )
+            labels = _format_labels(self.labels, values)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class TimedLock(asyncio.Lock):
+    """An asyncio.Lock that records how long it takes to acquire"""
+
+    def __init__(self, name):
+        super(TimedLock, self).__init__()
+        self.name = name
+
+    async def acquire(self):
+        start = monotonic()
+        with span("lock_wait", lock=self.name):
+            result = await super(TimedLock, self).acquire()
+        LOCK_WAIT.observe(monotonic() - start, self.name)
+        return result
+
+
+def render():
+    """Get every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+COMMANDS = Counter(
+    "corebot_commands_total", "Commands processed, by trigger", ("trigger",)
+)
+COMMAND_LATENCY = Histogram(
+    "corebot_command_latency_seconds",
+    "Time from a command arriving to it being processed, by trigger",
+    ("trigger",),
+)
+REDEMPTIONS = Counter(
+    "corebot_redemptions_total",
+    "Ticket redemptions, by ticket type and result",
+    ("ticket_type", "result"),
+)
+REQUEST_LATENCY = Histogram(
+    "corebot_request_latency_seconds",
+    "Time for a single request to the homeserver, by method",
+    ("method",),
+)
+INVITES_SKIPPED = Counter(
+    "corebot_invites_skipped_total",
+    "Room invites not sent because the user was already in the room",
+)
+LOCK_WAIT = Histogram(
+    "corebot_lock_wait_seconds", "Time spent waiting for a lock, by lock", ("lock",)
+)
+ANNOUNCEMENT_LAG = Histogram(
+    "corebot_announcement_lag_seconds",
+    "How long after their scheduled time announcements were sent",
+)
+WRITE_DURATION = Histogram(
+    "corebot_token_write_seconds",
+    "Time to write out a token table, by ticket type",
+    ("ticket_type",),
+)
+APPSERVICE_EVENTS = Counter(
+    "corebot_appservice_events_total",
+    "Events pushed to the bot by the homeserver in application service mode",
+)
+TOKENS_IMPORTED = Counter(
+    "corebot_tokens_imported_total",
+    "Tokens added while running, by ticket type",
+    ("ticket_type",),
+)
+
+OUTBOUND_DEPTH = Gauge(
+    "corebot_outbound_queue_depth", "Requests waiting or being sent to the homeserver"
+)
+COMMAND_QUEUE_DEPTH = Gauge(
+    "corebot_command_queue_depth", "Commands waiting for a worker"
+)
+
+
+class MetricsServer(object):
+    def __init__(self, host="127.0.0.1", port=9191):
+        """Serves the metrics over HTTP from the bot's event loop
+
+        Args:
+            host (str): The address to listen on
+
+            port (int): The port to listen on
+        """
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _metrics(self, request):
+        return web.Response(
+            body=render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
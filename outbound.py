@@ -0,0 +1,234 @@
+# coding=utf-8
+
+import asyncio
+import logging
+from time import monotonic
+from uuid import uuid4
+
+from aiohttp import ClientConnectionError
+from nio import AsyncClient, ErrorResponse
+
+from metrics import REQUEST_LATENCY
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        """Paces actions to rate per second, allowing bursts of up to burst
+
+        Args:
+            rate (float): Actions per second, 0 for no limit
+
+            burst (int): How many actions can be taken at once after a quiet spell
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = self.burst
+        self._updated = monotonic()
+        # Waiters take turns, so actions happen in the order they asked
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def full(self):
+        self._refill()
+        return self._tokens >= self.burst
+
+    async def acquire(self):
+        """Wait until an action is allowed"""
+        if not self.rate:
+            return
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class OutboundQueue(object):
+    def __init__(
+        self,
+        workers=16,
+        rate=50,
+        burst=100,
+        room_rate=1,
+        room_burst=5,
+        max_retries=5,
+        backoff=1,
+    ):
+        """Sends requests to the homeserver at a pace it will accept
+
+        Requests are paced by a global token bucket and, for messages, one per
+        room. A message waits for its room's pacing before it is queued, so a
+        busy room doesn't hold up the workers for everyone else. Requests
+        rejected with M_LIMIT_EXCEEDED are retried after the time the homeserver
+        asks for, and connection failures and timeouts are retried with
+        exponential backoff.
+
+        Args:
+            workers (int): How many requests can be in flight at once
+
+            rate (float): Requests per second overall, 0 for no limit
+
+            burst (int): Requests that can be sent at once overall
+
+            room_rate (float): Messages per second to a single room, 0 for no limit
+
+            room_burst (int): Messages that can be sent at once to a single room
+
+            max_retries (int): Retries before giving up on a request
+
+            backoff (float): Seconds to wait before the first retry, doubled each time
+        """
+        self.workers = workers
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._global = TokenBucket(rate, burst)
+        self._rooms = {}
+        self._queue = asyncio.Queue()
+        self._in_flight = 0
+        self._tasks = []
+
+    @property
+    def depth(self):
+        """Requests waiting or being sent"""
+        return self._queue.qsize() + self._in_flight
+
+    def start(self):
+        """Start the workers, must be called from the event loop"""
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._worker()) for _ in range(self.workers)
+            ]
+
+    async def stop(self):
+        """Stop the workers, failing anything still queued"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(ConnectionError("Outbound queue stopped"))
+
+    async def submit(self, room_id, send):
+        """Queue a request and wait for its response
+
+        Args:
+            room_id (str): The room to pace the request against, None to only
+                apply the global pacing
+
+            send (callable): Makes the request, called again for each retry
+
+        Returns:
+            The response from the last attempt
+        """
+        if room_id is not None:
+            await self._room_bucket(room_id).acquire()
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((room_id, send, future))
+        return await future
+
+    def _room_bucket(self, room_id):
+        bucket = self._rooms.get(room_id)
+        if bucket is None:
+            if len(self._rooms) > 4096:
+                # Forget rooms that have been quiet long enough to be back to full
+                self._rooms = {r: b for r, b in self._rooms.items() if not b.full}
+            bucket = self._rooms[room_id] = TokenBucket(self.room_rate, self.room_burst)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            room_id, send, future = await self._queue.get()
+            self._in_flight += 1
+            try:
+                resp = await self._send(room_id, send)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(resp)
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def _send(self, room_id, send):
+        attempt = 0
+        while True:
+            await self._global.acquire()
+            wait = self.backoff * 2**attempt
+            try:
+                resp = await send()
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(
+                    "Request to %s failed (%r), retrying in %ss", room_id, e, wait
+                )
+            else:
+                rate_limited = isinstance(resp, ErrorResponse) and (
+                    resp.status_code == "M_LIMIT_EXCEEDED"
+                )
+                if not rate_limited or attempt >= self.max_retries:
+                    return resp
+                if resp.retry_after_ms:
+                    wait = resp.retry_after_ms / 1000
+                logger.warning(
+                    "Rate limited sending to %s, retrying in %ss", room_id, wait
+                )
+            attempt += 1
+            await asyncio.sleep(wait)
+
+
+class QueuedAsyncClient(AsyncClient):
+    """An AsyncClient that sends messages and invites through an OutboundQueue"""
+
+    def __init__(self, *args, outbound=None, **kwargs):
+        super(QueuedAsyncClient, self).__init__(*args, **kwargs)
+        self.outbound = outbound or OutboundQueue()
+
+    async def room_send(
+        self,
+        room_id,
+        message_type,
+        content,
+        tx_id=None,
+        ignore_unverified_devices=False,
+    ):
+        # Keep the transaction ID across retries so the homeserver can dedupe them
+        tx_id = tx_id or str(uuid4())
+        parent = super(QueuedAsyncClient, self)
+
+        async def send():
+            with REQUEST_LATENCY.time("room_send"):
+                return await parent.room_send(
+                    room_id, message_type, content, tx_id, ignore_unverified_devices
+                )
+
+        return await self.outbound.submit(room_id, send)
+
+    async def room_invite(self, room_id, user_id):
+        # Invites to a room come from many users at once, so they only get the
+        # global pacing and whatever the homeserver asks for
+        parent = super(QueuedAsyncClient, self)
+
+        async def invite():
+            with REQUEST_LATENCY.time("room_invite"):
+                return await parent.room_invite(room_id, user_id)
+
+        return await self.outbound.submit(None, invite)
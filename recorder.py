@@ -0,0 +1,87 @@
+# coding=utf-8
+
+import copy
+import json
+import logging
+import re
+from time import time
+
+from disk_io import submit_io
+from token_backends import token_digest
+
+logger = logging.getLogger(__name__)
+
+# Anything that could be a ticket token, they are 64 characters
+TOKEN_RE = re.compile(r"<?\b[0-9A-Za-z]{32,}\b>?")
+
+
+def redact(body, secrets=()):
+    """Hash anything that looks like a token and blank out known secrets
+
+    Tokens are replaced by their digest, which is also 64 characters, so
+    replaying the message goes down the same path as the original did.
+
+    Args:
+        body (str): The message text
+
+        secrets (iterable): Strings to replace with <redacted>, e.g. passwords
+    """
+    body = TOKEN_RE.sub(lambda m: token_digest(m.group(0).strip("<>")), body)
+    for secret in secrets:
+        if secret:
+            body = body.replace(secret, "<redacted>")
+    return body
+
+
+class EventRecorder(object):
+    def __init__(self, path, user_id=None, secrets=()):
+        """Appends the message and invite events the bot receives to a JSONL file
+
+        Each line has when the event was received, what kind of event it was, the
+        room it came from and the event's source with any tokens in it hashed,
+        see redact. benchmarks/replay.py plays the file back.
+
+        Args:
+            path (str): The file to append to
+
+            user_id (str): The bot's user ID, its own messages aren't recorded
+
+            secrets (iterable): Strings to blank out of message bodies
+        """
+        self.path = path
+        self.user_id = user_id
+        self.secrets = [s for s in secrets if s]
+        self.recorded = 0
+        self._file = open(path, "a", buffering=1)
+        logger.info("Recording events to %s", path)
+
+    def _write(self, kind, room, source):
+        record = {
+            "time": time(),
+            "kind": kind,
+            "room": {"room_id": room.room_id, "is_group": room.is_group},
+            "event": source,
+        }
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        submit_io(self._file.write, line)
+        self.recorded += 1
+
+    async def message(self, room, event):
+        if event.sender == self.user_id:
+            return
+        source = copy.deepcopy(event.source)
+        content = source.get("content", {})
+        content.pop("formatted_body", None)
+        content.pop("format", None)
+        if "body" in content:
+            content["body"] = redact(content["body"], self.secrets)
+        self._write("message", room, source)
+
+    async def invite(self, room, event):
+        # nio takes the content out of the source when parsing member events
+        source = dict(event.source, content=event.content)
+        self._write("invite", room, source)
+
+    def close(self):
+        # After any writes still queued
+        submit_io(self._file.close)
@@ -0,0 +1,56 @@
+# coding=utf-8
+
+import logging
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class RoomAliasCache(object):
+    def __init__(self, ttl=3600, negative_ttl=60):
+        """Room IDs for aliases we've already resolved
+
+        Aliases that don't exist are remembered too, for a shorter time, so
+        repeated typos don't each cost a round trip.
+
+        Args:
+            ttl (float): Seconds to remember a room ID for
+
+            negative_ttl (float): Seconds to remember that an alias doesn't exist
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, alias):
+        """Look up an alias
+
+        Returns:
+            tuple: (cached, room ID or None if the alias doesn't exist)
+        """
+        entry = self._entries.get(alias)
+        if entry is None:
+            return False, None
+        room_id, expires = entry
+        if expires <= monotonic():
+            del self._entries[alias]
+            return False, None
+        return True, room_id
+
+    def put(self, alias, room_id):
+        """Remember what an alias resolved to, None if it doesn't exist"""
+        ttl = self.ttl if room_id is not None else self.negative_ttl
+        self._entries[alias] = (room_id, monotonic() + ttl)
+
+    def flush(self):
+        """Forget everything
+
+        Returns:
+            int: The number of entries dropped
+        """
+        count = len(self._entries)
+        self._entries = {}
+        return count
@@ -0,0 +1,160 @@
+# coding=utf-8
+
+import asyncio
+from datetime import datetime, timedelta
+import heapq
+from itertools import count
+import logging
+
+from dateutil import tz
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry(object):
+    __slots__ = ("time", "seq", "announcement", "prepare", "cancelled")
+
+    def __init__(self, time, seq, announcement, prepare):
+        self.time = time
+        self.seq = seq
+        self.announcement = announcement
+        self.prepare = prepare
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.time, self.seq) < (other.time, other.seq)
+
+
+class AnnouncementScheduler(object):
+    def __init__(self, lead_time=0):
+        """Fires announcements at their time from a single task
+
+        Announcements are kept in a min-heap on their time, and the task only
+        sleeps until the earliest one is due. Cancelled entries are marked and
+        dropped when they reach the top of the heap.
+
+        Args:
+            lead_time (float): Seconds before its time to call an announcement's
+                prepare coroutine, so only the send is left when it fires
+        """
+        self.lead_time = timedelta(seconds=lead_time)
+        self._heap = []
+        self._entries = {}
+        self._seq = count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Prepares and sends in progress, kept so they aren't garbage collected
+        self._running = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, announcement):
+        """Schedule an announcement, if it is in the future and not already scheduled
+
+        Args:
+            announcement (Announcement): Anything with a time and an announce coroutine
+
+        Returns:
+            bool: Whether the announcement is scheduled
+        """
+        if id(announcement) in self._entries:
+            return True
+        if announcement.time <= datetime.now(tz.UTC):
+            logger.debug("Not scheduling past announcement for %s", announcement.time)
+            return False
+        self._push(announcement, prepare=bool(self.lead_time))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return True
+
+    def _push(self, announcement, prepare):
+        time = announcement.time - self.lead_time if prepare else announcement.time
+        entry = _Entry(time, next(self._seq), announcement, prepare)
+        self._entries[id(announcement)] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def cancel(self, announcement):
+        """Stop an announcement from firing
+
+        Returns:
+            bool: Whether it was scheduled
+        """
+        entry = self._entries.pop(id(announcement), None)
+        if entry is None:
+            return False
+        entry.cancelled = True
+        self._wakeup.set()
+        return True
+
+    def cancel_all(self):
+        """Stop every scheduled announcement from firing"""
+        for entry in self._entries.values():
+            entry.cancelled = True
+        self._entries = {}
+        self._heap = []
+        self._wakeup.set()
+
+    def scheduled(self):
+        """Get the scheduled announcements, soonest first"""
+        return sorted(
+            (e.announcement for e in self._entries.values()), key=lambda a: a.time
+        )
+
+    async def stop(self):
+        """Cancel everything and stop the scheduler task"""
+        self.cancel_all()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    def _start(self, coro, what, announcement):
+        task = asyncio.create_task(coro)
+        self._running.add(task)
+
+        def done(task):
+            self._running.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(
+                    "Error in %s of announcement for %s",
+                    what,
+                    announcement.time,
+                    exc_info=task.exception(),
+                )
+
+        task.add_done_callback(done)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._heap[0].cancelled:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            wait_seconds = (self._heap[0].time - datetime.now(tz.UTC)).total_seconds()
+            if wait_seconds > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self._heap)
+            # Don't let a slow send hold up the next announcement
+            if entry.prepare:
+                self._start(entry.announcement.prepare(), "prepare", entry.announcement)
+                self._push(entry.announcement, prepare=False)
+            else:
+                del self._entries[id(entry.announcement)]
+                self._start(entry.announcement.announce(), "send", entry.announcement)
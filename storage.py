@@ -4,7 +4,7 @@ import logging
 import os.path
 import sqlite3
 
-latest_db_version = 0
+latest_db_version = 2
 
 logger = logging.getLogger(__name__)
 
@@ -32,8 +32,7 @@ class Storage(object):
         logger.info("Performing initial database setup...")
 
         # Initialize a connection to the database
-        self.conn = sqlite3.connect(self.db_path)
-        self.cursor = self.conn.cursor()
+        self._connect()
 
         # Sync token table
         self.cursor.execute(
@@ -42,11 +41,182 @@ class Storage(object):
             "token TEXT NOT NULL"
             ")"
         )
+        self._create_tokens_table()
+        self._create_processed_events_table()
+        self.cursor.execute(f"PRAGMA user_version = {latest_db_version}")
 
         logger.info("Database setup complete")
 
     def _run_migrations(self):
         """Execute database migrations"""
         # Initialize a connection to the database
+        self._connect()
+
+        db_version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        if db_version < 1:
+            logger.info("Migrating database to version 1")
+            self._create_tokens_table()
+        if db_version < 2:
+            logger.info("Migrating database to version 2")
+            self._create_processed_events_table()
+        if db_version < latest_db_version:
+            self.cursor.execute(f"PRAGMA user_version = {latest_db_version}")
+
+    def _connect(self):
         self.conn = sqlite3.connect(self.db_path)
         self.cursor = self.conn.cursor()
+        # Readers don't block the writer, and commits don't need a full fsync
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        self.cursor.execute("PRAGMA synchronous = NORMAL")
+        # This connection is used from the event loop, so a commit mustn't
+        # checkpoint (and fsync). checkpoint is run on the disk I/O thread instead
+        self.cursor.execute("PRAGMA wal_autocheckpoint = 0")
+
+    def _create_tokens_table(self):
+        # Ticket tokens, by sha256 digest, and who redeemed them
+        self.cursor.execute(
+            "CREATE TABLE tokens ("
+            "ticket_type TEXT NOT NULL, "
+            "digest TEXT NOT NULL, "
+            "holder TEXT NOT NULL DEFAULT 'unused', "
+            "PRIMARY KEY (ticket_type, digest)"
+            ")"
+        )
+        self.cursor.execute("CREATE INDEX tokens_holder ON tokens (holder)")
+
+    def _create_processed_events_table(self):
+        # Events the bot has acted on, by origin server timestamp in ms
+        self.cursor.execute(
+            "CREATE TABLE processed_events ("
+            "event_id TEXT PRIMARY KEY, "
+            "server_timestamp INTEGER NOT NULL"
+            ")"
+        )
+        self.cursor.execute(
+            "CREATE INDEX processed_events_timestamp "
+            "ON processed_events (server_timestamp)"
+        )
+
+    def get_sync_token(self):
+        """Get the sync token to resume syncing from, if there is one"""
+        self.cursor.execute("SELECT token FROM sync_token WHERE dedupe_id = 0")
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def save_sync_token(self, token):
+        """Remember the latest sync token so a restart can resume from it"""
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO sync_token (dedupe_id, token) VALUES (0, ?)",
+            (token,),
+        )
+        self.conn.commit()
+
+    def count_tokens(self, ticket_type):
+        """Get the number of tokens of a ticket type"""
+        self.cursor.execute(
+            "SELECT COUNT(*) FROM tokens WHERE ticket_type = ?", (ticket_type,)
+        )
+        return self.cursor.fetchone()[0]
+
+    def import_tokens(self, ticket_type, tokens):
+        """Add tokens to the database, leaving any that are already there alone
+
+        Uses its own connection, so it can be run from another thread.
+
+        Args:
+            ticket_type (str): attendee, volunteer or presenter
+
+            tokens (dict): Token digests and their holders
+
+        Returns:
+            int: The number of tokens added
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO tokens (ticket_type, digest, holder) VALUES (?, ?, ?)",
+                ((ticket_type, digest, holder) for digest, holder in tokens.items()),
+            )
+            conn.commit()
+            return conn.total_changes
+        finally:
+            conn.close()
+
+    def get_token_holder(self, ticket_type, digest):
+        """Get who holds a token, "unused" if nobody does or None if it doesn't exist"""
+        self.cursor.execute(
+            "SELECT holder FROM tokens WHERE ticket_type = ? AND digest = ?",
+            (ticket_type, digest),
+        )
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def is_token_holder(self, ticket_type, user):
+        """Check whether a user holds any token of a ticket type"""
+        self.cursor.execute(
+            "SELECT 1 FROM tokens WHERE holder = ? AND ticket_type = ? LIMIT 1",
+            (user, ticket_type),
+        )
+        return self.cursor.fetchone() is not None
+
+    def set_token_holder(self, ticket_type, digest, holder, expected):
+        """Change who holds a token, only if it is currently held by expected
+
+        Returns:
+            bool: Whether the token was changed
+        """
+        self.cursor.execute(
+            "UPDATE tokens SET holder = ? "
+            "WHERE ticket_type = ? AND digest = ? AND holder = ?",
+            (holder, ticket_type, digest, expected),
+        )
+        changed = self.cursor.rowcount == 1
+        self.conn.commit()
+        return changed
+
+    def is_event_processed(self, event_id):
+        """Check whether an event has been marked as processed"""
+        self.cursor.execute(
+            "SELECT 1 FROM processed_events WHERE event_id = ?", (event_id,)
+        )
+        return self.cursor.fetchone() is not None
+
+    def mark_event_processed(self, event_id, server_timestamp):
+        """Remember that an event has been processed"""
+        self.cursor.execute(
+            "INSERT OR IGNORE INTO processed_events (event_id, server_timestamp) "
+            "VALUES (?, ?)",
+            (event_id, server_timestamp),
+        )
+        self.conn.commit()
+
+    def unmark_event_processed(self, event_id):
+        """Forget that an event has been processed, so it is acted on again"""
+        self.cursor.execute(
+            "DELETE FROM processed_events WHERE event_id = ?", (event_id,)
+        )
+        self.conn.commit()
+
+    def prune_processed_events(self, before):
+        """Forget processed events sent before a server timestamp in ms
+
+        Returns:
+            int: The number of events forgotten
+        """
+        self.cursor.execute(
+            "DELETE FROM processed_events WHERE server_timestamp < ?", (before,)
+        )
+        pruned = self.cursor.rowcount
+        self.conn.commit()
+        return pruned
+
+    def checkpoint(self):
+        """Fold the write-ahead log back into the database file
+
+        Uses its own connection, so it can be run from another thread.
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        finally:
+            conn.close()
@@ -0,0 +1,181 @@
+# coding=utf-8
+
+import asyncio
+import logging
+import random
+from time import monotonic
+
+from aiohttp import ClientConnectionError, ServerDisconnectedError
+from nio import LocalProtocolError, LoginResponse, SyncError, SyncResponse
+
+from bot_actions import start_background, upload_sync_filter, warm_room_aliases
+
+logger = logging.getLogger(__name__)
+
+
+class SyncFailed(Exception):
+    """The homeserver answered a sync with an error"""
+
+    def __init__(self, response):
+        super(SyncFailed, self).__init__(str(response))
+        self.response = response
+
+
+class ConnectionSupervisor(object):
+    def __init__(self, client, config, initial_delay=1, max_delay=300):
+        """Keeps the client logged in and syncing, backing off while it can't
+
+        The delay between attempts doubles with each failure up to max_delay,
+        with random jitter so a restarted homeserver isn't hit by every client at
+        once. Waiting never blocks the event loop, so announcements, token syncs
+        and queued replies keep going during an outage.
+
+        Args:
+            client (nio.AsyncClient): The client to keep connected
+
+            config (Config): Bot configuration parameters
+
+            initial_delay (float): Seconds to wait after the first failure
+
+            max_delay (float): Most seconds to wait between attempts
+        """
+        self.client = client
+        self.config = config
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        # disconnected, connecting, syncing or backing_off
+        self.state = "disconnected"
+        self.failures = 0
+        self.syncs = 0
+        self.outage_started = None
+        self.last_outage = None
+        self._sync_filter = None
+        self._started = False
+        client.add_response_callback(self._synced, (SyncResponse,))
+        client.add_response_callback(self._sync_failed, (SyncError,))
+
+    @property
+    def outage_duration(self):
+        """Seconds since the connection was lost, or None if connected"""
+        if self.outage_started is None:
+            return None
+        return monotonic() - self.outage_started
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.info("Connection %s -> %s", self.state, state)
+            self.state = state
+
+    async def _sync_failed(self, response):
+        # Get out of sync_forever so the retry backs off instead of spinning
+        raise SyncFailed(response)
+
+    async def _login(self):
+        """Log in, unless we still have an access token from an earlier login
+
+        Returns:
+            bool: Whether we are logged in
+        """
+        if self.client.access_token:
+            logger.debug("Reusing access token for %s", self.client.device_id)
+            return True
+        try:
+            login_response = await self.client.login(
+                password=self.config.user_password,
+                device_name=self.config.device_name,
+            )
+        except LocalProtocolError as e:
+            # There's an edge case here where the user hasn't installed the correct C
+            # dependencies. In that case, a LocalProtocolError is raised on login.
+            logger.fatal(
+                "Failed to login. Have you installed the correct dependencies? "
+                "https://github.com/poljar/matrix-nio#installation "
+                "Error: %s",
+                e,
+            )
+            return False
+        if not isinstance(login_response, LoginResponse):
+            logger.error("Failed to login: %s", login_response.message)
+            return False
+        logger.info(f"Logged in as {self.config.user_id}")
+        return True
+
+    async def _synced(self, response):
+        self.syncs += 1
+        self._set_state("syncing")
+        if self.outage_started is not None:
+            self.last_outage = self.outage_duration
+            logger.warning("Reconnected after a %.1fs outage", self.last_outage)
+        self.outage_started = None
+        self.failures = 0
+
+    def _backoff_delay(self):
+        delay = min(self.max_delay, self.initial_delay * 2 ** (self.failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def run(self, full_state=False):
+        """Stay connected until cancelled
+
+        Args:
+            full_state (bool): Whether the first sync should get the full state
+
+        Returns:
+            bool: False if logging in failed for good
+        """
+        while True:
+            self._set_state("connecting")
+            syncs = self.syncs
+            try:
+                if not await self._login():
+                    return False
+
+                # Sync encryption keys with the server
+                # Required for participating in encrypted rooms
+                if self.client.should_upload_keys:
+                    await self.client.keys_upload()
+
+                if not self._started:
+                    self._started = True
+                    start_background(
+                        warm_room_aliases(self.client, self.config),
+                        "warming room aliases",
+                    )
+                # Not uploaded yet, or uploading it failed on the last connect
+                if self._sync_filter is None:
+                    self._sync_filter = await upload_sync_filter(
+                        self.client, self.config
+                    )
+                await self.client.sync_forever(
+                    timeout=30000, sync_filter=self._sync_filter, full_state=full_state
+                )
+            except (
+                ClientConnectionError,
+                ServerDisconnectedError,
+                asyncio.TimeoutError,
+                SyncFailed,
+            ) as e:
+                if isinstance(e, SyncFailed) and e.response.status_code in (
+                    "M_UNKNOWN_TOKEN",
+                    "M_MISSING_TOKEN",
+                ):
+                    logger.warning("Access token no longer valid, logging in again")
+                    self.client.access_token = ""
+                if self.outage_started is None:
+                    self.outage_started = monotonic()
+                self.failures += 1
+                delay = self._backoff_delay()
+                logger.warning(
+                    "Unable to sync with homeserver (%s), retrying in %.1fs "
+                    "(down for %.1fs)",
+                    e,
+                    delay,
+                    self.outage_duration,
+                )
+                self._set_state("backing_off")
+                await asyncio.sleep(delay)
+            finally:
+                # Only the first successful sync needs the full state
+                if self.syncs > syncs:
+                    full_state = False
+                # Make sure to close the client connection on disconnect
+                await self.client.close()
@@ -0,0 +1,79 @@
+# coding=utf-8
+
+import asyncio
+
+import pytest
+
+import disk_io
+from journal import Journal
+from token_backends import CsvTokenBackend, read_token_csv
+
+
+def write_tokens(path, count):
+    with open(path, "w") as f:
+        for i in range(count):
+            f.write(f"d{i},unused\n")
+
+
+@pytest.mark.parametrize("newest_first", [False, True])
+def test_overlapping_writes_lose_no_redemptions(tmp_path, newest_first):
+    path = str(tmp_path / "attendees.csv")
+    write_tokens(path, 8)
+
+    async def run():
+        backend = CsvTokenBackend("attendee", path, asyncio.Lock(), 0.001)
+
+        async def redeem(*ids):
+            for i in ids:
+                backend.claim(f"d{i}", f"@u{i}:example.org")
+            await asyncio.gather(
+                *(backend.commit(f"d{i}", f"@u{i}:example.org") for i in ids)
+            )
+
+        await redeem(0, 1, 2)
+        older = backend.snapshot()
+        await redeem(3, 4)
+        newer = backend.snapshot()
+        await redeem(5, 6, 7)
+        snapshots = (newer, older) if newest_first else (older, newer)
+        await asyncio.gather(*(backend.write(s) for s in snapshots))
+        return backend.tokens
+
+    expected = asyncio.run(run())
+    # What a restart would load
+    tokens = read_token_csv(path, "attendee")
+    Journal(path + ".journal").replay(tokens)
+    assert tokens == expected
+    assert "unused" not in tokens.values()
+
+
+def test_rows_appended_mid_write_are_kept(tmp_path, monkeypatch):
+    path = str(tmp_path / "attendees.csv")
+    write_tokens(path, 1)
+
+    async def run():
+        backend = CsvTokenBackend("attendee", path, asyncio.Lock(), 0.001)
+        # An export still being appended to, its last line half written
+        with open(path, "a") as f:
+            f.write("d1,unu")
+        real_fsync = disk_io.fsync
+        appended = []
+
+        def fsync(fd):
+            # The rest arrives while the new file is being written
+            if not appended:
+                appended.append(True)
+                with open(path, "a") as f:
+                    f.write("sed\nd2,unused\n")
+            real_fsync(fd)
+
+        monkeypatch.setattr(disk_io, "fsync", fsync)
+        backend.claim("d0", "@u0:example.org")
+        await backend.commit("d0", "@u0:example.org")
+        await backend.write(backend.snapshot())
+        return await disk_io.run_io(backend.tail.read_new)
+
+    new = asyncio.run(run())
+    with open(path) as f:
+        assert f.read() == "d0,@u0:example.org\nd1,unused\nd2,unused\n"
+    assert new == {"d1": "unused", "d2": "unused"}
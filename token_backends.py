@@ -0,0 +1,347 @@
+# coding=utf-8
+
+from abc import ABC, abstractmethod
+import asyncio
+import csv
+from hashlib import sha256
+import logging
+from os import stat
+
+from disk_io import run_io, write_csv_atomic
+from journal import Journal
+
+logger = logging.getLogger(__name__)
+
+TICKET_TYPES = ["attendee", "volunteer", "presenter"]
+
+
+def token_digest(token):
+    """Get the digest a ticket token is stored under"""
+    h = sha256()
+    h.update(token.encode("utf-8"))
+    return h.hexdigest()
+
+
+def read_token_csv(path, ticket_type, required=False):
+    """Load a token csv of digest,holder rows, or nothing if there isn't one
+
+    Raises:
+        FileNotFoundError: If required is set and there is no csv
+    """
+    try:
+        with open(path, "r") as f:
+            reader = csv.reader(f)
+            return dict(reader)
+    except FileNotFoundError:
+        if required:
+            raise
+        logger.error("No %s tokens csv at %s", ticket_type, path)
+        return {}
+
+
+class TokenFileTail(object):
+    def __init__(self, path):
+        """Reads the rows added to the end of a token csv since it was last read
+
+        Only the new bytes are read and parsed. If the file is replaced, e.g. by a
+        fresh export, it is read again from the start. Everything but reset runs
+        on the disk I/O thread.
+
+        Args:
+            path (str): The token csv
+        """
+        self.path = path
+        self.offset = 0
+        self.inode = None
+
+    def keep_from(self):
+        """Get where the bytes that haven't been read yet start
+
+        Returns:
+            int: Offset in the current file, 0 if it has been replaced since
+        """
+        try:
+            if stat(self.path).st_ino == self.inode:
+                return self.offset
+        except FileNotFoundError:
+            pass
+        return 0
+
+    def replaced(self, offset):
+        """Carry on from offset in a new file written over the old one"""
+        self.offset, self.inode = offset, stat(self.path).st_ino
+
+    def reset(self):
+        """Skip everything currently in the file"""
+        try:
+            st = stat(self.path)
+        except FileNotFoundError:
+            self.offset, self.inode = 0, None
+            return
+        self.offset, self.inode = st.st_size, st.st_ino
+
+    def read_new(self):
+        """Get the rows added since the last read
+
+        A last line without a newline may still be being written, so it is left
+        for next time.
+
+        Returns:
+            dict: Holders of the new token digests
+        """
+        try:
+            st = stat(self.path)
+        except FileNotFoundError:
+            return {}
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.offset, self.inode = 0, st.st_ino
+        if st.st_size == self.offset:
+            return {}
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        tokens = {}
+        for row in csv.reader(data[:end].decode("utf-8").splitlines()):
+            if len(row) != 2:
+                if row:
+                    logger.warning("Skipping bad row in %s: %r", self.path, row)
+                continue
+            tokens[row[0]] = row[1]
+        return tokens
+
+
+class TokenBackend(ABC):
+    """Where the tokens for a ticket type are kept and who has redeemed them
+
+    Backends must implement the abstract methods, or creating one fails.
+
+    claim, release and snapshot are called with lock held. generation is bumped
+    on every change so write_csv can skip tables that haven't changed since they
+    were last persisted.
+    """
+
+    def __init__(self, ticket_type, path, lock, required=False):
+        """
+        Args:
+            ticket_type (str): attendee, volunteer or presenter
+
+            path (str): The token csv for this ticket type
+
+            lock (asyncio.Lock): Held while the tokens are changed or written
+
+            required (bool): Whether a missing csv stops the bot starting,
+                rather than leaving the ticket type with no tokens
+        """
+        self.ticket_type = ticket_type
+        self.path = path
+        self.lock = lock
+        self.required = required
+        # Held by write_csv from taking a snapshot until it is written, so
+        # snapshots are written one at a time and in order
+        self.write_lock = asyncio.Lock()
+        self.generation = 0
+        self.persisted_generation = 0
+        # Picks up tokens added to the csv while the bot is running
+        self.tail = TokenFileTail(path)
+
+    @abstractmethod
+    def holder(self, digest):
+        """Get who holds a token, "unused" if nobody does or None if it doesn't exist"""
+
+    @abstractmethod
+    def is_holder(self, user):
+        """Check whether user has redeemed any token"""
+
+    @abstractmethod
+    def claim(self, digest, sender):
+        """Take a token for sender if it is unused or already theirs
+
+        Returns:
+            tuple: (claimed, previous holder of the token)
+        """
+
+    @abstractmethod
+    def release(self, digest, sender, previous):
+        """Give a claimed token back to its previous holder"""
+
+    async def commit(self, digest, sender):
+        """Make a completed redemption durable"""
+
+    @abstractmethod
+    async def merge(self, tokens):
+        """Add tokens that aren't in the table yet, leaving existing ones alone
+
+        Called without lock held, new tokens can't clash with a claim.
+
+        Returns:
+            int: The number of tokens added
+        """
+
+    def snapshot(self):
+        """Copy what write needs, cheaply enough to do while holding the lock"""
+        return None
+
+    async def write(self, snapshot):
+        """Persist the whole table as it was when snapshot was taken
+
+        Called without the lock held, so claims can carry on meanwhile.
+        """
+
+
+class CsvTokenBackend(TokenBackend):
+    def __init__(self, ticket_type, path, lock, commit_delay, required=False):
+        """Tokens held in memory, written to a csv and journalled in between
+
+        Args:
+            commit_delay (float): How long the journal batches redemptions for
+        """
+        super(CsvTokenBackend, self).__init__(ticket_type, path, lock, required)
+        self.tokens = read_token_csv(path, ticket_type, required)
+        self.tail.reset()
+        self.journal = Journal(path + ".journal", commit_delay)
+        self._written_mark = 0
+        # Anything replayed from the journal still needs writing out
+        self.generation = self.journal.replay(self.tokens)
+
+    def holder(self, digest):
+        return self.tokens.get(digest)
+
+    def is_holder(self, user):
+        return user in self.tokens.values()
+
+    def claim(self, digest, sender):
+        previous = self.tokens.get(digest)
+        if previous not in ("unused", sender):
+            return False, previous
+        if previous != sender:
+            self.tokens[digest] = sender
+            self.generation += 1
+        return True, previous
+
+    def release(self, digest, sender, previous):
+        if self.tokens.get(digest) == sender and previous != sender:
+            self.tokens[digest] = previous
+            self.generation += 1
+
+    async def commit(self, digest, sender):
+        await self.journal.append(digest, sender)
+
+    async def merge(self, tokens):
+        added = 0
+        for digest, holder in tokens.items():
+            if digest not in self.tokens:
+                self.tokens[digest] = holder
+                added += 1
+        if added:
+            self.generation += 1
+        return added
+
+    def snapshot(self):
+        return list(self.tokens.items()), self.journal.mark()
+
+    def _write_snapshot(self, rows):
+        # Rows appended since the tail last read them, including a last line
+        # still being written, are kept after the snapshot to be read next time
+        size = write_csv_atomic(self.path, rows, keep_from=self.tail.keep_from())
+        self.tail.replaced(size)
+
+    async def write(self, snapshot):
+        rows, mark = snapshot
+        # A newer snapshot has already been written over this one
+        if mark < self._written_mark:
+            return
+        self._written_mark = mark
+        await run_io(self._write_snapshot, rows)
+        # Journal entries up to the mark are now in the snapshot, anything
+        # journalled since is kept for the next one
+        await self.journal.truncate(mark)
+
+
+class SqliteTokenBackend(TokenBackend):
+    def __init__(self, ticket_type, path, lock, store, required=False):
+        """Tokens held in the bot's SQLite database
+
+        The first time a ticket type is used the csv (and its journal, if any) is
+        imported into the database. After that tokens in the csv that aren't in
+        the database are added, from the whole file once at startup and then
+        from the rows appended to it.
+
+        Args:
+            store (Storage): Bot storage
+        """
+        super(SqliteTokenBackend, self).__init__(ticket_type, path, lock, required)
+        self.store = store
+        if not store.count_tokens(ticket_type):
+            tokens = read_token_csv(path, ticket_type, required)
+            Journal(path + ".journal").replay(tokens)
+            imported = store.import_tokens(ticket_type, tokens)
+            logger.info("Imported %d %s tokens from %s", imported, ticket_type, path)
+            self.tail.reset()
+
+    def holder(self, digest):
+        return self.store.get_token_holder(self.ticket_type, digest)
+
+    def is_holder(self, user):
+        return self.store.is_token_holder(self.ticket_type, user)
+
+    def claim(self, digest, sender):
+        previous = self.holder(digest)
+        if previous not in ("unused", sender):
+            return False, previous
+        if previous != sender:
+            # Conditional so two processes sharing the database can't both win
+            if not self.store.set_token_holder(
+                self.ticket_type, digest, sender, previous
+            ):
+                return False, self.holder(digest)
+            self.generation += 1
+        return True, previous
+
+    def release(self, digest, sender, previous):
+        if previous != sender and self.store.set_token_holder(
+            self.ticket_type, digest, previous, sender
+        ):
+            self.generation += 1
+
+    async def merge(self, tokens):
+        added = await run_io(self.store.import_tokens, self.ticket_type, tokens)
+        if added:
+            self.generation += 1
+        return added
+
+    async def write(self, snapshot):
+        await run_io(self.store.checkpoint)
+
+
+def load_token_backends(config, store):
+    """Set up the token backend for each ticket type, as chosen in the config
+
+    Args:
+        config (Config): Bot configuration parameters
+
+        store (Storage): Bot storage
+
+    Returns:
+        dict: TokenBackend by ticket type
+    """
+    paths = {
+        "attendee": (config.tokens_path, config._attendee_token_lock),
+        "volunteer": (config.volunteer_tokens_path, config._volunteer_token_lock),
+        "presenter": (config.presenter_tokens_path, config._presenter_token_lock),
+    }
+    backends = {}
+    for ticket_type in TICKET_TYPES:
+        path, lock = paths[ticket_type]
+        # tokens_path is a required option, the others are optional extras
+        required = ticket_type == "attendee"
+        if config.token_backend == "sqlite":
+            backends[ticket_type] = SqliteTokenBackend(
+                ticket_type, path, lock, store, required
+            )
+        else:
+            backends[ticket_type] = CsvTokenBackend(
+                ticket_type, path, lock, config.journal_commit_delay, required
+            )
+    return backends
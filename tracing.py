@@ -0,0 +1,171 @@
+# coding=utf-8
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import random
+from time import monotonic, time
+from uuid import uuid4
+
+from disk_io import submit_io
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar("current_span", default=None)
+_tracer = None
+
+
+class Span(object):
+    def __init__(self, trace, name, parent, attrs, start=None):
+        self.trace = trace
+        self.id = len(trace.spans)
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.start = monotonic() if start is None else start
+        self.duration = None
+        trace.spans.append(self)
+
+    def finish(self, end=None):
+        self.duration = (monotonic() if end is None else end) - self.start
+
+    def to_dict(self, origin):
+        return {
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "offset_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "attrs": self.attrs,
+        }
+
+
+class Trace(object):
+    def __init__(self, name, attrs, start=None):
+        """The spans recorded while handling one thing, e.g. a command
+
+        Args:
+            name (str): What is being traced
+
+            attrs (dict): Attributes of the root span
+
+            start (float): monotonic() time it started, defaults to now
+        """
+        self.id = uuid4().hex[:16]
+        self.time = time()
+        self.spans = []
+        self.root = Span(self, name, None, attrs, start)
+
+    def to_dict(self):
+        origin = self.root.start
+        return {
+            "trace_id": self.id,
+            "time": self.time,
+            "name": self.root.name,
+            "duration_ms": round(self.root.duration * 1000, 3),
+            "attrs": self.root.attrs,
+            "spans": [s.to_dict(origin) for s in self.spans[1:]],
+        }
+
+
+class Tracer(object):
+    def __init__(self, path=None, sample_rate=0.0, slow_threshold=10.0):
+        """Decides which traces to keep and writes them out
+
+        Every trace is recorded, but only a sample_rate fraction of them is
+        written, plus any that took slow_threshold seconds or longer.
+
+        Args:
+            path (str): JSONL file to append traces to, None to log them instead
+
+            sample_rate (float): Fraction of traces to keep, 0 to 1
+
+            slow_threshold (float): Seconds after which a trace is always kept,
+                None to only sample
+        """
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.path = path
+        self._file = open(path, "a", buffering=1) if path else None
+        self.emitted = 0
+
+    def finish(self, trace):
+        slow = False
+        if self.slow_threshold is not None:
+            slow = trace.root.duration >= self.slow_threshold
+        if not slow and random.random() >= self.sample_rate:
+            return
+        line = json.dumps(trace.to_dict(), separators=(",", ":"))
+        self.emitted += 1
+        if self._file is not None:
+            submit_io(self._file.write, line + "\n")
+        elif slow:
+            logger.warning("Slow %s trace: %s", trace.root.name, line)
+        else:
+            logger.info("Trace: %s", line)
+
+    def close(self):
+        if self._file is not None:
+            # After any writes still queued
+            submit_io(self._file.close)
+            self._file = None
+
+
+def configure(path=None, sample_rate=0.0, slow_threshold=10.0):
+    """Turn on tracing, see Tracer for the arguments"""
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = Tracer(path, sample_rate, slow_threshold)
+    return _tracer
+
+
+@contextmanager
+def start_trace(name, started=None, **attrs):
+    """Trace the with block, does nothing unless configure has been called
+
+    Args:
+        name (str): What is being traced
+
+        started (float): monotonic() time the work arrived, if it waited before
+            the with block. The wait is recorded as a queued span.
+
+        attrs: Attributes of the root span
+    """
+    if _tracer is None:
+        yield None
+        return
+    trace = Trace(name, attrs, started)
+    if started is not None:
+        Span(trace, "queued", trace.root.id, {}, started).finish()
+    token = _current.set(trace.root)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        trace.root.finish()
+        _tracer.finish(trace)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Record the with block as a child of the current span, if there is one"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.id, attrs)
+    token = _current.set(child)
+    try:
+        yield child
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def annotate(**attrs):
+    """Add attributes to the current span, if there is one"""
+    current = _current.get()
+    if current is not None:
+        current.attrs.update(attrs)